@@ -13,4 +13,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'GroupExp.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from rest.sse import EventStreamRouter  # noqa: E402, needs the apps to be loaded
+
+application = EventStreamRouter(django_application)
@@ -45,13 +45,46 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest.authentication.SignedTokenAuthentication',
         'rest_framework.authentication.TokenAuthentication',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
-    ]
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'rest.pagination.IdCursorPagination',
+    'PAGE_SIZE': 50,
 }
 
+# Lifetimes in seconds of the signed tokens issued by the login endpoint
+SIGNED_TOKEN_ACCESS_LIFETIME = 5 * 60
+SIGNED_TOKEN_REFRESH_LIFETIME = 7 * 24 * 60 * 60
+# How often each process reloads the revoked access tokens, see rest/authentication.py
+SIGNED_TOKEN_REVOCATION_RELOAD = 10
+
+# Seconds a confirmed party membership is remembered by IsPartyMember
+PARTY_MEMBERSHIP_CACHE_TIMEOUT = 30
+
+# Seconds after which a running calculation job is given to another worker,
+# and how many times a job is tried before it fails for good
+CALCULATION_JOB_TIMEOUT = 5 * 60
+CALCULATION_JOB_ATTEMPTS = 3
+
+# seconds between keep-alive comments on idle billing event streams
+EVENT_STREAM_HEARTBEAT = 15
+
+BATCH_MAX_REQUESTS = 50
+
+# per route histograms of every request, served at /api/v2/metrics to staff
+REQUEST_METRICS = True
+
+# where requests profiled with X-Profile: 1 are kept, only the newest ones
+PROFILE_CAPTURE_DIR = BASE_DIR / 'profiles'
+PROFILE_CAPTURES_KEPT = 20
+
 DJOSER = {
     'PASSWORD-RESET-CONFIRM-URL': '#/password/reset/confirm/{uid}/{token}',
     'USERNAME-RESET-CONFIRM-URL': '#/username/reset/confirm/{uid}/{token}',
@@ -66,6 +99,7 @@ DJOSER = {
 }
 
 MIDDLEWARE = [
+    'rest.middleware.request_metrics',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,6 +107,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'rest.middleware.request_profiler',
+    'rest.middleware.async_reads',
 ]
 
 ROOT_URLCONF = 'GroupExp.urls'
@@ -102,11 +138,28 @@ WSGI_APPLICATION = 'GroupExp.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # django.db.backends.sqlite3 with immediate transactions, see rest/db.py
+        'ENGINE': 'rest.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {
+            # seconds a writer waits for the lock held by another process
+            'timeout': 20,
+        },
     }
 }
 
+# Applied to every new SQLite connection, see rest/db.py for the locking strategy.
+# WAL mode is stored in the database file, migration 0024 switches to it once.
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,
+    'temp_store': 'MEMORY',
+}
+# Writers of one process queue up on a lock in rest.db.write_transaction
+SQLITE_SERIALIZE_WRITES = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -12,6 +12,9 @@ from rest.models import *
 @admin.register(Contribution)
 @admin.register(DebtRecord)
 @admin.register(DebtFromChangeRecord)
+@admin.register(MemberBalance)
+@admin.register(CalculationJob)
+@admin.register(RevokedToken)
 class PersonAdmin(admin.ModelAdmin):
     pass
 
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class RestConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rest'
+
+    def ready(self):
+        from rest import signals  # noqa: F401
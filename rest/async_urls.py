@@ -0,0 +1,14 @@
+from django.urls import include, path
+from django.urls.resolvers import URLPattern
+
+from rest.async_views import offload
+from rest.urls import router
+
+# read endpoints polled by clients, served from the executor pool under ASGI
+HOT_ROUTES = {'party-list', 'party-detail', 'billing-detail', 'billing-choices'}
+
+urlpatterns = [
+    path('api/v2/', include([URLPattern(route.pattern, offload(route.callback), route.default_args, route.name)
+                             for route in router.urls if route.name in HOT_ROUTES])),
+    path('', include('GroupExp.urls')),
+]
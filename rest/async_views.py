@@ -0,0 +1,23 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+
+def offload(view):
+    # Django 3.2 has no async ORM. Under ASGI a sync view is run on the one
+    # thread shared by all sync code, so the whole view is moved to the
+    # executor pool instead, where reads can run side by side.
+    def run(request, *args, **kwargs):
+        try:
+            response = view(request, *args, **kwargs)
+            if callable(getattr(response, 'render', None)):
+                response.render()
+            return response
+        finally:
+            close_old_connections()
+
+    @wraps(view)
+    async def async_view(request, *args, **kwargs):
+        return await sync_to_async(run, thread_sensitive=False)(request, *args, **kwargs)
+    return async_view
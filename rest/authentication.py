@@ -0,0 +1,136 @@
+import secrets
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from rest.models import RevokedToken
+
+ACCESS = 'access'
+REFRESH = 'refresh'
+
+
+def _lifetime(kind):
+    if kind == ACCESS:
+        return settings.SIGNED_TOKEN_ACCESS_LIFETIME
+    return settings.SIGNED_TOKEN_REFRESH_LIFETIME
+
+
+def _issue(user, kind):
+    payload = {'uid': user.id, 'staff': user.is_staff, 'jti': secrets.token_urlsafe(12)}
+    return signing.dumps(payload, salt=f"rest.signed-token.{kind}")
+
+
+def issue_tokens(user):
+    return {ACCESS: _issue(user, ACCESS), REFRESH: _issue(user, REFRESH)}
+
+
+def read_token(token, kind):
+    try:
+        payload = signing.loads(token, salt=f"rest.signed-token.{kind}", max_age=_lifetime(kind))
+    except signing.SignatureExpired:
+        raise AuthenticationFailed("Token has expired.")
+    except signing.BadSignature:
+        raise AuthenticationFailed("Invalid token.")
+    if kind == ACCESS and payload['jti'] in revoked_access:
+        raise AuthenticationFailed("Token has been revoked.")
+    return payload
+
+
+class RevokedAccessTokens:
+    """The revoked access tokens, reloaded from the database on an interval.
+
+    Access tokens are checked on every request, so they are looked up in this
+    process-local set instead of the table. A revocation made by another
+    process applies here after at most SIGNED_TOKEN_REVOCATION_RELOAD seconds.
+    """
+
+    def __init__(self):
+        self.jtis = frozenset()
+        self.loaded = None
+
+    def __contains__(self, jti):
+        if self.loaded is None or time.monotonic() - self.loaded >= settings.SIGNED_TOKEN_REVOCATION_RELOAD:
+            self.reload()
+        return jti in self.jtis
+
+    def reload(self):
+        # revoked refresh tokens expire later than any access token
+        now = timezone.now()
+        horizon = now + timedelta(seconds=settings.SIGNED_TOKEN_ACCESS_LIFETIME)
+        self.jtis = frozenset(RevokedToken.objects.filter(expires__gt=now, expires__lte=horizon)
+                              .values_list('jti', flat=True))
+        self.loaded = time.monotonic()
+
+    def add(self, jti):
+        self.jtis = self.jtis | {jti}
+
+
+revoked_access = RevokedAccessTokens()
+
+
+def _revoke(payload, kind):
+    now = timezone.now()
+    RevokedToken.objects.filter(expires__lt=now).delete()
+    expires = now + timedelta(seconds=_lifetime(kind))
+    _, created = RevokedToken.objects.get_or_create(jti=payload['jti'], defaults={'expires': expires})
+    return created
+
+
+def revoke_access(payload):
+    revoked_access.add(payload['jti'])
+    return _revoke(payload, ACCESS)
+
+
+def revoke_refresh(payload):
+    return _revoke(payload, REFRESH)
+
+
+def refresh_tokens(token):
+    payload = read_token(token, REFRESH)
+    user = User.objects.filter(pk=payload['uid'], is_active=True).first()
+    if user is None or not revoke_refresh(payload):
+        raise AuthenticationFailed("Token has been revoked.")
+    return issue_tokens(user)
+
+
+class TokenUser(SimpleLazyObject):
+    """The user named by a signed token.
+
+    id and the permission flags come from the token itself, the user row is
+    only loaded once any other attribute is used.
+    """
+
+    def __init__(self, payload):
+        super().__init__(lambda: User.objects.get(pk=payload['uid']))
+        self.__dict__.update(id=payload['uid'], pk=payload['uid'], is_staff=payload['staff'],
+                             is_active=True, is_authenticated=True, is_anonymous=False)
+
+    def __bool__(self):
+        return True
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed("Invalid token header.")
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed("Invalid token header.")
+        payload = read_token(token, ACCESS)
+        return TokenUser(payload), payload
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -0,0 +1,10 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        # Django starts atomic blocks with a deferred BEGIN. A transaction that
+        # reads before it writes then fails at once with "database is locked"
+        # when another connection committed in between, the busy timeout only
+        # applies to a lock taken up front.
+        self.cursor().execute("BEGIN IMMEDIATE")
@@ -0,0 +1,100 @@
+from django.db.models import Case, F, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+
+from rest.db import write_transaction
+from rest.models import Billing, Choice, Contribution, MemberBalance, Record
+from rest.settlement import allocate
+
+
+def refresh_balances(billing, record_ids=(), user_ids=()):
+    """Bring the materialized member balances of a billing up to date.
+
+    record_ids are the records whose price, quantity or choices changed, their
+    price is re-split between the current pickers. user_ids are members whose
+    choices or contributions changed in some other way, e.g. were deleted.
+    """
+    users = set(user_ids)
+    with write_transaction():
+        if record_ids:
+            users |= split_records(record_ids)
+        if users:
+            _update_member_balances(billing, users)
+        touch_billing(billing)
+
+
+def reserve_quantity(record_id, quantity):
+    # a single guarded statement, nothing is changed if not enough is left
+    return Record.objects.filter(pk=record_id, picked_quantity__lte=F('quantity') - quantity)\
+        .update(picked_quantity=F('picked_quantity') + quantity)
+
+
+def release_quantity(record_id, quantity):
+    Record.objects.filter(pk=record_id).update(picked_quantity=F('picked_quantity') - quantity)
+
+
+def adjust_picked_quantities(deltas):
+    """Apply {record_id: delta} to the picked quantities in one statement.
+
+    Returns the products that are now over-picked, the caller is expected to
+    roll the transaction back if there are any.
+    """
+    deltas = {record_id: delta for record_id, delta in deltas.items() if delta}
+    if not deltas:
+        return []
+    Record.objects.filter(id__in=deltas).update(picked_quantity=F('picked_quantity') + Case(
+        *[When(id=record_id, then=delta) for record_id, delta in deltas.items()], default=0))
+    increased = [record_id for record_id, delta in deltas.items() if delta > 0]
+    return list(Record.objects.filter(id__in=increased, picked_quantity__gt=F('quantity'))
+                .order_by('id').values_list('product', flat=True))
+
+
+def touch_billing(billing):
+    Billing.objects.filter(pk=billing.pk).update(version=F('version') + 1)
+    billing.refresh_from_db(fields=['version'])
+
+
+def split_records(record_ids):
+    totals = dict(Record.objects.filter(id__in=record_ids)
+                  .annotate(total=F('price') * F('quantity')).values_list('id', 'total'))
+    choices = list(Choice.objects.filter(record_id__in=totals)
+                   .only('id', 'record_id', 'user_id', 'quantity', 'share').order_by('record_id', 'id'))
+    index = {record_id: i for i, record_id in enumerate(totals)}
+    shares = allocate([index[choice.record_id] for choice in choices],
+                      [choice.quantity for choice in choices],
+                      list(totals.values()))
+
+    changed = []
+    for choice, share in zip(choices, shares):
+        if choice.share != share:
+            choice.share = share
+            changed.append(choice)
+    Choice.objects.bulk_update(changed, ['share'], batch_size=500)
+    return {choice.user_id for choice in choices}
+
+
+def _update_member_balances(billing, user_ids):
+    owed = dict(billing.choices.filter(user_id__in=user_ids)
+                .values_list('user_id').annotate(total=Sum('share')).order_by())
+    contributed = dict(Contribution.objects.filter(billing=billing, user_id__in=user_ids)
+                       .values_list('user_id').annotate(total=Sum('contribution')).order_by())
+    existing = {balance.user_id: balance for balance in billing.balances.filter(user_id__in=user_ids)}
+    created = []
+    for user_id in user_ids:
+        balance = existing.get(user_id) or MemberBalance(billing=billing, user_id=user_id)
+        balance.owed = owed.get(user_id, 0)
+        balance.contributed = contributed.get(user_id, 0)
+        if user_id not in existing:
+            created.append(balance)
+    MemberBalance.objects.bulk_update(existing.values(), ['owed', 'contributed'])
+    MemberBalance.objects.bulk_create(created)
+
+
+def rebuild_balances(billing):
+    with write_transaction():
+        billing.balances.all().delete()
+        picked = Choice.objects.filter(record=OuterRef('pk')).values('record').annotate(total=Sum('quantity'))
+        billing.records.update(picked_quantity=Coalesce(Subquery(picked.values('total')), 0))
+        users = split_records(list(billing.records.values_list('id', flat=True)))
+        users |= set(billing.contributions.values_list('user_id', flat=True))
+        _update_member_balances(billing, users)
+        touch_billing(billing)
@@ -0,0 +1,67 @@
+import io
+import json
+
+from django.db import transaction
+from django.http import HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+
+from rest.db import write_transaction
+
+# headers of the batch request itself that must not leak into its parts
+SKIPPED_META = {'CONTENT_TYPE', 'CONTENT_LENGTH', 'HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+                'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE'}
+
+
+def _resolve(path):
+    try:
+        match = resolve('/' + path, urlconf='rest.urls')
+    except Resolver404:
+        return None
+    # only the router's viewset routes can be batched, not login, batch itself etc.
+    return match if getattr(match.func, 'actions', None) else None
+
+
+def _sub_request(request, method, path, query, body, memberships):
+    data = json.dumps(body).encode() if body is not None else b''
+    sub = HttpRequest()
+    sub.method = method
+    sub.path = sub.path_info = path
+    sub.META = {key: value for key, value in request.META.items() if key not in SKIPPED_META}
+    sub.META.update(REQUEST_METHOD=method, PATH_INFO=path, QUERY_STRING=query,
+                    CONTENT_TYPE='application/json', CONTENT_LENGTH=str(len(data)))
+    sub.GET = QueryDict(query)
+    sub._stream = io.BytesIO(data)
+    sub._read_started = False
+    # the batch was authenticated once, its parts share the user and the membership checks
+    sub._force_auth_user = request.user
+    sub._force_auth_token = request.auth
+    sub._party_memberships = memberships
+    return sub
+
+
+def run_batch(request, items):
+    """Run the sub-requests in order in one transaction.
+
+    Stops at the first failing one and rolls everything back. Returns the
+    responses so far and whether the batch was committed.
+    """
+    prefix = request.path[:-len('batch')]
+    memberships = {}
+    responses = []
+    with write_transaction():
+        for item in items:
+            path, _, query = item['path'].partition('?')
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+            match = _resolve(path.lstrip('/'))
+            if match is None:
+                responses.append({'status': 404, 'body': {'detail': f"No batchable route for {item['path']}"}})
+            else:
+                sub = _sub_request(request, item['method'], prefix + path.lstrip('/'), query, item.get('body'),
+                                   memberships)
+                response = match.func(sub, *match.args, **match.kwargs)
+                responses.append({'status': response.status_code, 'body': getattr(response, 'data', None)})
+            if responses[-1]['status'] >= 400:
+                transaction.set_rollback(True)
+                return responses, False
+    return responses, True
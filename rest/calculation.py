@@ -0,0 +1,143 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from rest.db import write_transaction
+from rest.events import CALCULATION_READY, publish_on_commit
+from rest.models import Billing, CalculationJob, DebtRecord, DebtFromChangeRecord
+from rest.serializers import ResultSerializer
+from rest.settlement import Settlement
+
+
+# errors of failures that are not caused by the billing, a new submission retries them
+RETRYABLE_ERRORS = ("Calculation failed", "Calculation timed out")
+
+
+class CalculationError(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_code = 'calculation_error'
+
+
+def collect_balances(billing):
+    # Member balances are kept up to date by rest.balances whenever the
+    # billing changes, so only the per-member rows have to be read here.
+    if not billing.records.exists():
+        raise CalculationError("Billing is empty. Nothing to calculate")
+
+    settlement = Settlement(billing.total)
+    for user_id, owed, contributed in billing.balances.values_list('user_id', 'owed', 'contributed'):
+        settlement.add_contribution(user_id, contributed)
+        settlement.add_debt(user_id, owed)
+    if settlement.total_balance < 0:
+        raise CalculationError("Unable to calculate - total contribution is not enough")
+
+    unpicked = list(billing.records.filter(picked_quantity__lt=F('quantity'))
+                    .order_by('id').values_list('product', flat=True))
+    if unpicked:
+        raise CalculationError(f"Some amount of {', '.join(unpicked)} is left unpicked")
+    return settlement
+
+
+def result_cache_key(billing, mode):
+    return f"billing-result:{billing.id}:{billing.version}:{mode}"
+
+
+def get_result(billing, mode, save=True):
+    # A result is computed once per (billing, version, mode). The debt rows
+    # are rewritten only when save is set and they belong to another version.
+    saved = billing.calculated_version == billing.version and billing.calculated_mode == mode
+    key = result_cache_key(billing, mode)
+    if saved or not save:
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    if saved:
+        debts = billing.debts.select_related('debtor', 'creditor')
+        change = billing.change.select_related('creditor')
+    else:
+        users = {user.id: user for user in billing.party.members.all()}
+        debts, change = collect_balances(billing).final(billing, users, mode)
+        if save:
+            debts, change = save_result(billing, mode, debts, change)
+    data = ResultSerializer({'debts': debts, 'change': change}).data
+    # a rolled back version number is reused, so only committed results are cached
+    transaction.on_commit(lambda: cache.set(key, data))
+    return data
+
+
+def save_result(billing, mode, debt_records, from_change):
+    with write_transaction():
+        billing.debts.all().delete()
+        billing.change.all().delete()
+
+        debts = DebtRecord.objects.bulk_create(debt_records)
+        change = DebtFromChangeRecord.objects.bulk_create(from_change)
+        # if the billing changed meanwhile the rows stay marked as outdated
+        if Billing.objects.filter(pk=billing.pk, version=billing.version).update(
+                calculated_version=billing.version, calculated_mode=mode):
+            publish_on_commit(billing, CALCULATION_READY, mode=mode)
+    return debts, change
+
+
+def submit_job(billing, mode):
+    # jobs for the same billing version are coalesced into one
+    job, created = CalculationJob.objects.get_or_create(billing=billing, version=billing.version, mode=mode)
+    if not created and job.status == CalculationJob.FAILED and job.error.startswith(RETRYABLE_ERRORS):
+        retry = {'status': CalculationJob.PENDING, 'error': '', 'claimed': None, 'attempts': 0}
+        if CalculationJob.objects.filter(pk=job.pk, status=CalculationJob.FAILED).update(**retry):
+            for name, value in retry.items():
+                setattr(job, name, value)
+    return job
+
+
+def claim_job():
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.CALCULATION_JOB_TIMEOUT)
+    # the worker of a stale job died, it is taken again unless it was tried too often
+    CalculationJob.objects.filter(status=CalculationJob.RUNNING, claimed__lt=stale,
+                                  attempts__gte=settings.CALCULATION_JOB_ATTEMPTS).update(
+        status=CalculationJob.FAILED, error="Calculation timed out")
+    claimable = Q(status=CalculationJob.PENDING) | Q(status=CalculationJob.RUNNING, claimed__lt=stale)
+    for job_id, claimed in CalculationJob.objects.filter(claimable).order_by('id').values_list('id', 'claimed'):
+        if CalculationJob.objects.filter(claimable, pk=job_id, claimed=claimed).update(
+                status=CalculationJob.RUNNING, claimed=now, attempts=F('attempts') + 1):
+            return CalculationJob.objects.select_related('billing__party').get(pk=job_id)
+    return None
+
+
+def run_job(job):
+    billing = job.billing
+    try:
+        # a result of another version must not be stored under this one
+        if billing.version != job.version:
+            job.status = CalculationJob.SUPERSEDED
+        else:
+            result = get_result(billing, job.mode)
+            if Billing.objects.filter(pk=billing.pk, version=job.version).exists():
+                job.result = result
+                job.status = CalculationJob.DONE
+            else:
+                # the billing changed while the result was computed
+                job.status = CalculationJob.SUPERSEDED
+    except CalculationError as e:
+        job.error = str(e.detail)
+        job.status = CalculationJob.FAILED
+    except OperationalError as e:
+        # e.g. a locked database, the job is tried again later
+        job.error = f"Calculation failed: {e}"[:200]
+        job.status = (CalculationJob.PENDING if job.attempts < settings.CALCULATION_JOB_ATTEMPTS
+                      else CalculationJob.FAILED)
+    except Exception as e:
+        job.error = f"Calculation failed: {e.__class__.__name__}"[:200]
+        job.status = CalculationJob.FAILED
+        raise
+    finally:
+        job.save(update_fields=['result', 'error', 'status', 'updated'])
+    return job
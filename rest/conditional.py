@@ -0,0 +1,31 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response
+
+
+def make_etag(request, *parts):
+    # the same version is rendered differently by the browsable API
+    return '"{}"'.format('-'.join(str(part) for part in (*parts, request.accepted_renderer.format)))
+
+
+def billing_etag(request, billing):
+    return make_etag(request, 'billing', billing.id, billing.version,
+                     billing.calculated_version, billing.calculated_mode or '')
+
+
+def party_etag(request, party):
+    return make_etag(request, 'party', party.id, party.version)
+
+
+def list_etag(request, name, versions):
+    # a page depends on the query string and on every object it may contain
+    digest = hashlib.md5(repr((request.get_full_path(), versions)).encode()).hexdigest()
+    return make_etag(request, name, digest)
+
+
+def conditional_response(request, etag):
+    """Return a 304 or 412 response if the request preconditions say so."""
+    response = get_conditional_response(request, etag=etag)
+    if response is not None and response.status_code == 304:
+        response['ETag'] = etag
+    return response
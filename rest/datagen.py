@@ -0,0 +1,100 @@
+import os
+import random
+import tempfile
+from contextlib import contextmanager
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from rest.balances import rebuild_balances
+from rest.db import write_transaction
+from rest.membership import Membership
+from rest.models import Billing, Choice, Contribution, Party, Profile, Record
+from rest.search import index_user
+
+UNIFORM = 'uniform'
+SKEWED = 'skewed'
+DISTRIBUTIONS = [UNIFORM, SKEWED]
+
+
+@contextmanager
+def scratch_database():
+    """Run the block against a migrated throwaway SQLite file."""
+    path = os.path.join(tempfile.mkdtemp(), 'scratch.sqlite3')
+    connection.settings_dict['TEST']['NAME'] = path
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    setup_test_environment()
+    try:
+        yield
+    finally:
+        teardown_test_environment()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def draw(rng, bounds, distribution=UNIFORM):
+    low, high = bounds
+    if distribution == SKEWED:
+        # most values close to low with a long tail, like real party sizes
+        return min(high, low + int((rng.paretovariate(1.5) - 1) * max(1, (high - low) / 4)))
+    return rng.randint(low, high)
+
+
+def generate(parties=10, users=None, members=(2, 8), records=(5, 30), quantity=(1, 4), price=(50, 5000),
+             friends=(0, 10), distribution=UNIFORM, seed=0, prefix='gen', password='password'):
+    """Fill the database with a consistent synthetic data set.
+
+    Every unit of every record is picked and every billing is fully paid,
+    so all billings can be calculated. Returns the generated billings.
+    """
+    rng = random.Random(seed)
+    users = users or max(members[1], parties * (members[0] + members[1]) // 4)
+    password = make_password(password)
+    with write_transaction():
+        User.objects.bulk_create([User(username=f"{prefix}{i}", email=f"{prefix}{i}@example.com",
+                                       password=password) for i in range(users)])
+        people = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+        Profile.objects.bulk_create([Profile(user_id=user.id) for user in people])
+        profiles = list(Profile.objects.filter(user__in=people).order_by('id'))
+        for user in people:
+            index_user(user)
+
+        through = Profile.friends.through
+        friendships = set()
+        for profile in profiles:
+            for friend in rng.sample(profiles, min(len(profiles), draw(rng, friends, distribution))):
+                if friend.id != profile.id:
+                    friendships.add((profile.id, friend.id))
+        through.objects.bulk_create([through(from_profile_id=a, to_profile_id=b) for a, b in friendships])
+
+        billings = []
+        for p in range(parties):
+            party_members = rng.sample(people, min(len(people), draw(rng, members, distribution)))
+            party = Party.objects.create(name=f"{prefix} party {p}", host=party_members[0])
+            Membership.objects.bulk_create([Membership(party_id=party.id, user_id=user.id) for user in party_members])
+            billing = Billing.objects.create(party=party)
+            Record.objects.bulk_create([Record(product=f"item {r}", quantity=draw(rng, quantity),
+                                               price=draw(rng, price), billing=billing)
+                                        for r in range(draw(rng, records, distribution))])
+
+            picks = {}
+            for record in billing.records.all():
+                for _ in range(record.quantity):
+                    key = (rng.choice(party_members).id, record.id)
+                    picks[key] = picks.get(key, 0) + 1
+            Choice.objects.bulk_create([Choice(user_id=user_id, record_id=record_id, billing=billing, quantity=q)
+                                        for (user_id, record_id), q in picks.items()])
+
+            billing.total = sum(record.price * record.quantity for record in billing.records.all())
+            billing.save(update_fields=['total'])
+            payers = rng.sample(party_members, rng.randint(1, min(3, len(party_members))))
+            remaining = billing.total + rng.randint(0, billing.total // 10)
+            for i, payer in enumerate(payers):
+                left = len(payers) - i - 1
+                amount = rng.randint(1, remaining - left) if left else remaining
+                remaining -= amount
+                Contribution.objects.create(user=payer, contribution=amount, billing=billing)
+            rebuild_balances(billing)
+            billings.append(billing)
+    return billings
@@ -0,0 +1,36 @@
+"""SQLite connection tuning and writer serialization.
+
+SQLite lets any number of readers run next to a single writer once the
+database is in WAL mode (migration 0024). Django opens transactions with a
+deferred BEGIN, and a deferred transaction that read before it writes fails
+with "database is locked" right away when another connection wrote in the
+meantime, without waiting for the busy timeout. The rest.backends.sqlite3
+engine therefore starts every transaction with BEGIN IMMEDIATE, which takes
+the write lock up front and waits for it through the busy timeout, in this
+process and in others. On top of that write_transaction holds a process wide
+lock for the whole transaction, so writers of one process queue up in Python
+instead of polling the file lock. Readers never take the lock.
+SQLITE_SERIALIZE_WRITES = False turns the lock off.
+"""
+import threading
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.db import transaction
+
+_write_lock = threading.RLock()
+
+
+def configure_connection(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+@contextmanager
+def write_transaction(using=None):
+    lock = _write_lock if settings.SQLITE_SERIALIZE_WRITES else nullcontext()
+    with lock, transaction.atomic(using=using):
+        yield
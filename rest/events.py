@@ -0,0 +1,83 @@
+import asyncio
+import itertools
+import json
+import threading
+
+from django.db import transaction
+
+CHOICES_CHANGED = 'choices_changed'
+RECORDS_UPDATED = 'records_updated'
+CONTRIBUTION_ADDED = 'contribution_added'
+CONTRIBUTION_UPDATED = 'contribution_updated'
+CONTRIBUTION_REMOVED = 'contribution_removed'
+CALCULATION_READY = 'calculation_ready'
+# sent instead of the events a slow subscriber had no room for
+RESYNC = 'resync'
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_subscribers = {}
+
+
+class Subscription:
+    """Events of one billing, delivered to an asyncio consumer.
+
+    publish() may be called from any thread, messages are handed over to
+    the consumer's event loop.
+    """
+
+    def __init__(self, billing_id, loop=None, maxsize=100):
+        self.billing_id = billing_id
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        self.lagged = False
+
+    def _put(self, message):
+        if self.queue.full():
+            self.lagged = True
+            return
+        self.queue.put_nowait(message)
+
+    def deliver(self, message):
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    async def get(self):
+        message = await self.queue.get()
+        if self.lagged:
+            # the missed events can't be replayed, the client has to refetch
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.lagged = False
+            return format_event(next(_ids), RESYNC, {'billing': self.billing_id})
+        return message
+
+    def __enter__(self):
+        with _lock:
+            _subscribers.setdefault(self.billing_id, set()).add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _lock:
+            subscribers = _subscribers.get(self.billing_id, set())
+            subscribers.discard(self)
+            if not subscribers:
+                _subscribers.pop(self.billing_id, None)
+
+
+def format_event(event_id, event, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def publish(billing_id, event, data):
+    with _lock:
+        subscribers = list(_subscribers.get(billing_id, ()))
+    if not subscribers:
+        return
+    message = format_event(next(_ids), event, data)
+    for subscription in subscribers:
+        subscription.deliver(message)
+
+
+def publish_on_commit(billing, event, **data):
+    payload = {'billing': billing.id, 'version': billing.version, **data}
+    transaction.on_commit(lambda: publish(billing.id, event, payload))
@@ -0,0 +1,165 @@
+import json
+import statistics
+import time
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from rest.balances import touch_billing
+from rest.datagen import SKEWED, generate, scratch_database
+from rest.membership import Membership
+
+BASELINE = Path(__file__).resolve().parents[2] / 'bench_baseline.json'
+
+
+class Command(BaseCommand):
+    help = ("Drive the API routes over generated data, report latency and query counts per endpoint "
+            "and fail on regressions against the stored baseline")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parties', type=int, default=20)
+        parser.add_argument('--iterations', type=int, default=60)
+        parser.add_argument('--warmup', type=int, default=10, help="Untimed requests before each endpoint")
+        parser.add_argument('--repeats', type=int, default=3,
+                            help="Timed rounds per endpoint, the reported figures are their medians")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', default=str(BASELINE))
+        parser.add_argument('--update-baseline', action='store_true', help="Store this run as the new baseline")
+        parser.add_argument('--latency-tolerance', type=float, default=1.5,
+                            help="Allowed p50 growth factor, latency depends on the machine")
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            billings = generate(parties=options['parties'], members=(3, 30), records=(5, 80), friends=(0, 40),
+                                distribution=SKEWED, seed=options['seed'], prefix='bench')
+            results = Benchmark(billings, options['iterations'], options['warmup'], options['repeats']).run()
+
+        self.stdout.write(f"{'endpoint':<18} {'p50 ms':>8} {'p95 ms':>8} {'queries':>8}")
+        for name, result in results.items():
+            self.stdout.write(f"{name:<18} {result['p50']:>8.2f} {result['p95']:>8.2f} {result['queries']:>8}")
+
+        path = Path(options['baseline'])
+        if options['update_baseline']:
+            path.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+            self.stdout.write(f"Baseline written to {path}")
+            return
+        if not path.exists():
+            raise CommandError(f"No baseline at {path}, run with --update-baseline first")
+        regressions = compare(json.loads(path.read_text()), results, options['latency_tolerance'])
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n" + "\n".join(regressions))
+        self.stdout.write("No regressions against the baseline")
+
+
+def compare(baseline, results, tolerance):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result['queries'] > expected['queries']:
+            regressions.append(f"{name}: {result['queries']} queries, baseline {expected['queries']}")
+        # p95 is reported but not gated, it follows single slow requests; the
+        # slack keeps sub-millisecond endpoints from failing on noise
+        if result['p50'] > expected['p50'] * tolerance + 1:
+            regressions.append(f"{name}: p50 {result['p50']:.2f} ms, baseline {expected['p50']:.2f} ms")
+    return regressions
+
+
+class Benchmark:
+    def __init__(self, billings, iterations, warmup, repeats):
+        self.billings = billings
+        self.iterations = iterations
+        self.warmup = warmup
+        self.repeats = repeats
+        self.client = APIClient()
+        self.users = list(User.objects.order_by('id')[:100])
+        self.dropped = {}
+
+    def run(self):
+        return {
+            'billing_retrieve': self.measure(self.billing_retrieve),
+            'calculate': self.measure(self.calculate),
+            'choices_post': self.measure(self.choices_post),
+            'invite': self.measure(self.invite),
+            'friends_get': self.measure(self.friends_get),
+            'friends_post': self.measure(self.friends_post),
+        }
+
+    def measure(self, endpoint):
+        # warm-up fills the caches and the connection, then the figures are
+        # the medians over several rounds so that one slow round doesn't count
+        for i in range(self.warmup):
+            self.call(endpoint, i)
+        p50s, p95s, queries = [], [], []
+        for _ in range(self.repeats):
+            latencies = []
+            for i in range(self.iterations):
+                latency, count = self.call(endpoint, i)
+                latencies.append(latency)
+                queries.append(count)
+            p50s.append(statistics.median(latencies))
+            p95s.append(statistics.quantiles(latencies, n=20)[-1])
+        return {
+            'p50': round(statistics.median(p50s), 2),
+            'p95': round(statistics.median(p95s), 2),
+            'queries': max(queries),
+        }
+
+    def call(self, endpoint, i):
+        billing = self.billings[i % len(self.billings)]
+        request, cleanup = endpoint(billing)
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = request()
+            latency = (time.perf_counter() - start) * 1000
+        if response.status_code >= 400:
+            raise CommandError(f"{endpoint.__name__} failed with {response.status_code}: {response.data}")
+        if cleanup:
+            cleanup()
+        return latency, len(captured)
+
+    def login(self, billing):
+        self.client.force_authenticate(billing.party.host)
+
+    def billing_retrieve(self, billing):
+        self.login(billing)
+        return lambda: self.client.get(f"/api/v2/billings/{billing.id}"), None
+
+    def calculate(self, billing):
+        self.login(billing)
+        # a new version, so that the result is really computed
+        touch_billing(billing)
+        return lambda: self.client.post(f"/api/v2/billings/{billing.id}/calculate"), None
+
+    def choices_post(self, billing):
+        self.login(billing)
+        url = f"/api/v2/billings/{billing.id}/choices"
+        picks = [{"record": choice["record"], "quantity": choice["quantity"]} for choice in self.client.get(url).data]
+        # every other round drops the first pick, the next one restores it
+        if billing.id in self.dropped:
+            picks.append(self.dropped.pop(billing.id))
+        elif picks:
+            self.dropped[billing.id] = picks.pop(0)
+        return lambda: self.client.post(url, picks, format='json'), None
+
+    def invite(self, billing):
+        self.login(billing)
+        members = set(billing.party.members.values_list('id', flat=True))
+        guests = [user.id for user in self.users if user.id not in members][:10]
+        url = f"/api/v2/parties/{billing.party_id}/invite"
+        return (lambda: self.client.post(url, [{"id": user_id} for user_id in guests], format='json'),
+                lambda: Membership.objects.filter(party_id=billing.party_id, user_id__in=guests).delete())
+
+    def friends_get(self, billing):
+        self.login(billing)
+        return lambda: self.client.get("/api/v2/users/me/friends"), None
+
+    def friends_post(self, billing):
+        self.login(billing)
+        members = [{"id": user_id} for user_id in billing.party.members.values_list('id', flat=True)[:10]]
+        return lambda: self.client.post("/api/v2/users/me/friends", members, format='json'), None
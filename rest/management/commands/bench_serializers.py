@@ -0,0 +1,67 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from rest.calculation import get_result
+from rest.datagen import generate, scratch_database
+from rest.models import Billing, Party
+from rest.renderers import FastJSONRenderer
+from rest.serializers import BillingReadSerializer, BillingSerializer, PartyReadSerializer, PartySerializer
+
+
+class Command(BaseCommand):
+    help = ("Compare the model serializers and JSONRenderer with the read serializers and FastJSONRenderer "
+            "on large billings")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=40)
+        parser.add_argument('--records', type=int, default=400)
+        parser.add_argument('--parties', type=int, default=50)
+        parser.add_argument('--iterations', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            billing, = generate(parties=1, members=(options['members'],) * 2, records=(options['records'],) * 2,
+                                friends=(0, 0), prefix='large')
+            get_result(billing, 'greedy')
+            generate(parties=options['parties'], users=options['members'], friends=(0, 0), prefix='party')
+            host = billing.party.host
+            host.parties.add(*Party.objects.all())
+
+            def model_billing():
+                instance = BillingSerializer.setup_eager_loading(Billing.objects.select_related('party')).get(
+                    id=billing.id)
+                return JSONRenderer().render(BillingSerializer(instance).data)
+
+            def read_billing():
+                instance = BillingSerializer.setup_select_related(Billing.objects.select_related('party')).get(
+                    id=billing.id)
+                return FastJSONRenderer().render(BillingReadSerializer(instance).data)
+
+            def model_parties():
+                parties = PartySerializer.setup_eager_loading(host.parties.order_by('id'))
+                return JSONRenderer().render(PartySerializer(parties, many=True).data)
+
+            def read_parties():
+                parties = list(PartySerializer.setup_select_related(host.parties.order_by('id')))
+                return FastJSONRenderer().render(PartyReadSerializer(parties, many=True).data)
+
+            self.stdout.write(f"{'payload':<10} {'bytes':>9} {'model ms':>9} {'read ms':>9} {'speedup':>8}")
+            for name, model, read in (('billing', model_billing, read_billing),
+                                      ('parties', model_parties, read_parties)):
+                if model() != read():
+                    raise CommandError(f"The read serializer output differs for {name}")
+                model_ms = self.measure(model, options['iterations'])
+                read_ms = self.measure(read, options['iterations'])
+                self.stdout.write(f"{name:<10} {len(read()):>9} {model_ms:>9.2f} {read_ms:>9.2f} "
+                                  f"{model_ms / read_ms:>7.1f}x")
+
+    def measure(self, render, iterations):
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            render()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
@@ -0,0 +1,47 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from rest.settlement import Settlement, GREEDY, MIN_TRANSFERS
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark of the settlement engine for growing party sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+        parser.add_argument('--choices-per-member', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write(f"{'members':>8} {'mode':>7} {'balances ms':>12} {'settle ms':>10} {'transfers':>10}")
+        for size in options['sizes']:
+            debts = [(rng.randrange(size), rng.randint(1, 5000))
+                     for _ in range(size * options['choices_per_member'])]
+            total = sum(debt for _, debt in debts)
+            contributions = _split_randomly(rng, total, size)
+            for mode in (GREEDY, MIN_TRANSFERS):
+                build_time = settle_time = 0
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    settlement = Settlement(total)
+                    for user_id, contribution in contributions:
+                        settlement.add_contribution(user_id, contribution)
+                    for user_id, debt in debts:
+                        settlement.add_debt(user_id, debt)
+                    built = time.perf_counter()
+                    transfers = settlement.transfers(mode)
+                    build_time += built - start
+                    settle_time += time.perf_counter() - built
+                self.stdout.write(f"{size:>8} {mode:>7} {build_time * 1000 / options['repeat']:>12.2f} "
+                                  f"{settle_time * 1000 / options['repeat']:>10.2f} {len(transfers):>10}")
+
+
+def _split_randomly(rng, total, size):
+    payers = rng.sample(range(size), max(1, size // 10))
+    cuts = sorted(rng.randint(0, total) for _ in range(len(payers) - 1))
+    amounts = [b - a for a, b in zip([0] + cuts, cuts + [total])]
+    return [(user_id, amount) for user_id, amount in zip(payers, amounts) if amount > 0]
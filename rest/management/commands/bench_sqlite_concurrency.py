@@ -0,0 +1,89 @@
+import random
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from rest.datagen import generate, scratch_database
+
+
+class Command(BaseCommand):
+    help = ("Measure billing reads while choices and calculate writes run concurrently, untuned and with the "
+            "pragmas and the write lock")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--duration', type=float, default=5.0)
+        parser.add_argument('--members', type=int, default=20)
+        parser.add_argument('--records', type=int, default=100)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            self.stderr.write("This benchmark only applies to SQLite")
+            return
+        self.stdout.write(f"{'setup':>8} {'reads/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'writes/s':>9} {'errors':>7}")
+        # the baseline has neither the pragmas, WAL mode nor the serialized writers
+        with override_settings(SQLITE_PRAGMAS={'journal_mode': 'DELETE'}, SQLITE_SERIALIZE_WRITES=False):
+            self.run_once('default', options)
+        self.run_once('tuned', options)
+
+    def run_once(self, label, options):
+        with scratch_database():
+            billing, = generate(parties=1, members=(options['members'],) * 2, records=(options['records'],) * 2,
+                                friends=(0, 0))
+            users = list(billing.party.members.all())
+            connection.close()
+            stop = threading.Event()
+            reads, writes, errors = [], [], []
+            threads = [threading.Thread(target=_reader, args=(billing, users, stop, reads, errors))
+                       for _ in range(options['readers'])]
+            threads += [threading.Thread(target=_writer, args=(billing, users, stop, writes, errors))
+                        for _ in range(options['writers'])]
+            for thread in threads:
+                thread.start()
+            time.sleep(options['duration'])
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        duration = options['duration']
+        p50 = statistics.median(reads) * 1000 if reads else 0
+        p95 = statistics.quantiles(reads, n=20)[-1] * 1000 if len(reads) > 1 else p50
+        self.stdout.write(f"{label:>8} {len(reads) / duration:>8.1f} {p50:>8.1f} {p95:>8.1f} "
+                          f"{len(writes) / duration:>9.1f} {len(errors):>7}")
+
+
+def _reader(billing, users, stop, reads, errors):
+    client = APIClient()
+    client.force_authenticate(random.choice(users))
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            client.get(f"/api/v2/billings/{billing.id}")
+            reads.append(time.perf_counter() - start)
+        except OperationalError as e:
+            errors.append(e)
+    connection.close()
+
+
+def _writer(billing, users, stop, writes, errors):
+    client = APIClient()
+    url = f"/api/v2/billings/{billing.id}/choices"
+    while not stop.is_set():
+        client.force_authenticate(random.choice(users))
+        try:
+            picks = [{"record": choice["record"], "quantity": choice["quantity"]} for choice in client.get(url).data]
+            # drop one pick and put it back, so that every round changes the billing
+            for submitted in (picks[1:], picks):
+                client.post(url, submitted, format='json')
+                writes.append(1)
+            client.post(f"/api/v2/billings/{billing.id}/calculate")
+            writes.append(1)
+        except OperationalError as e:
+            errors.append(e)
+    connection.close()
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from rest.calculation import claim_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Process queued billing calculation jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = claim_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            try:
+                run_job(job)
+            except Exception as e:
+                self.stderr.write(f"Job {job.id} failed: {e!r}")
+            else:
+                self.stdout.write(f"Job {job.id} for billing {job.billing_id}: {job.status}")
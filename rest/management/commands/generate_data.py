@@ -0,0 +1,43 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from rest.datagen import DISTRIBUTIONS, UNIFORM, generate
+
+
+def bounds(value):
+    low, _, high = value.partition('-')
+    try:
+        low, high = int(low), int(high or low)
+    except ValueError:
+        raise CommandError(f"Expected a number or a range like 2-8, got {value!r}")
+    if low < 0 or high < low:
+        raise CommandError(f"Invalid range {value!r}")
+    return low, high
+
+
+class Command(BaseCommand):
+    help = "Generate parties, billings, records, choices, contributions and friends for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parties', type=int, default=10)
+        parser.add_argument('--users', type=int, help="Size of the user pool (default: derived from parties)")
+        parser.add_argument('--members', type=bounds, default=(2, 8), help="Members per party, e.g. 2-8")
+        parser.add_argument('--records', type=bounds, default=(5, 30), help="Records per billing")
+        parser.add_argument('--quantity', type=bounds, default=(1, 4), help="Quantity per record")
+        parser.add_argument('--price', type=bounds, default=(50, 5000), help="Price per unit")
+        parser.add_argument('--friends', type=bounds, default=(0, 10), help="Friends per user")
+        parser.add_argument('--distribution', choices=DISTRIBUTIONS, default=UNIFORM,
+                            help="How party, billing and friend list sizes are drawn from their ranges")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='gen', help="Username prefix, must not be in use yet")
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(f"Users starting with {options['prefix']!r} exist already, pick another --prefix")
+        billings = generate(parties=options['parties'], users=options['users'], members=options['members'],
+                            records=options['records'], quantity=options['quantity'], price=options['price'],
+                            friends=options['friends'], distribution=options['distribution'],
+                            seed=options['seed'], prefix=options['prefix'])
+        records = sum(billing.records.count() for billing in billings)
+        self.stdout.write(f"Generated {len(billings)} parties with {records} records, "
+                          f"users are {options['prefix']}N with password 'password'")
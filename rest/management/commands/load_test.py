@@ -0,0 +1,94 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Hold many keep-alive connections against a running server and report read throughput. "
+            "Run it once against the WSGI server and once against the ASGI one to compare them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help="Server root, e.g. http://127.0.0.1:8000")
+        parser.add_argument('--path', action='append', dest='paths',
+                            help="Path to request, can be repeated (default: /api/v2/parties)")
+        parser.add_argument('--token', help="Signed access token sent as a Bearer token")
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--duration', type=float, default=10.0)
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http' or not url.hostname:
+            raise CommandError("Only plain http:// servers are supported")
+        paths = options['paths'] or ['/api/v2/parties']
+        headers = f"Host: {url.netloc}\r\n"
+        if options['token']:
+            headers += f"Authorization: Bearer {options['token']}\r\n"
+        requests = [f"GET {path} HTTP/1.1\r\n{headers}\r\n".encode() for path in paths]
+
+        start = time.perf_counter()
+        latencies, statuses, errors = asyncio.run(self.run(url.hostname, url.port or 80, requests, options))
+        # requests sent just before the deadline are still answered, an
+        # overloaded server takes well past --duration to drain them
+        duration = time.perf_counter() - start
+        self.stdout.write(f"{len(latencies)} responses in {duration:.1f}s over {options['connections']} connections, "
+                          f"{len(latencies) / duration:.1f} req/s")
+        if len(latencies) > 1:
+            cuts = statistics.quantiles(latencies, n=100)
+            self.stdout.write(f"p50 {cuts[49] * 1000:.1f} ms, p95 {cuts[94] * 1000:.1f} ms, "
+                              f"p99 {cuts[98] * 1000:.1f} ms")
+        self.stdout.write(f"statuses {dict(sorted(statuses.items()))}, connection errors {errors}")
+
+    async def run(self, host, port, requests, options):
+        latencies, statuses, errors = [], {}, [0]
+        deadline = time.perf_counter() + options['duration']
+        await asyncio.gather(*(self.connection(host, port, requests, i, deadline, latencies, statuses, errors)
+                               for i in range(options['connections'])))
+        return latencies, statuses, errors[0]
+
+    async def connection(self, host, port, requests, offset, deadline, latencies, statuses, errors):
+        writer = None
+        i = offset
+        while time.perf_counter() < deadline:
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(host, port)
+                start = time.perf_counter()
+                writer.write(requests[i % len(requests)])
+                status, keep_alive = await read_response(reader)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+                i += 1
+                if not keep_alive:
+                    writer.close()
+                    writer = None
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors[0] += 1
+                if writer is not None:
+                    writer.close()
+                    writer = None
+                await asyncio.sleep(0.1)
+        if writer is not None:
+            writer.close()
+
+
+async def read_response(reader):
+    status = int((await reader.readline()).split()[1])
+    length, keep_alive = None, True
+    while True:
+        line = (await reader.readline()).strip()
+        if not line:
+            break
+        name, _, value = line.decode('latin1').partition(':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            keep_alive = value != 'close'
+    if length is None:
+        await reader.read()
+        return status, False
+    await reader.readexactly(length)
+    return status, keep_alive
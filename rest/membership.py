@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from rest.models import Party
+
+Membership = Party.members.through
+
+
+def membership_cache_key(user_id, party):
+    # a ban bumps the party's version in the database, which every worker
+    # process reads along with the party, so stale entries are never hit
+    return f"party-member:{party.id}:{party.version}:{user_id}"
+
+
+def is_member(request, party):
+    user = request.user
+    if not user.is_authenticated:
+        return False
+    memo = getattr(request, '_party_memberships', None)
+    if memo is None:
+        memo = request._party_memberships = {}
+    if party.id not in memo:
+        memo[party.id] = _is_member(user.id, party)
+    return memo[party.id]
+
+
+def _is_member(user_id, party):
+    prefetched = getattr(party, '_prefetched_objects_cache', {}).get('members')
+    if prefetched is not None:
+        return any(member.id == user_id for member in prefetched)
+    # only confirmed memberships are cached, so an invite takes effect at once
+    key = membership_cache_key(user_id, party)
+    if cache.get(key):
+        return True
+    if not Membership.objects.filter(party_id=party.id, user_id=user_id).exists():
+        return False
+    transaction.on_commit(lambda: cache.set(key, True, settings.PARTY_MEMBERSHIP_CACHE_TIMEOUT))
+    return True
+
+
+def find_users(user_ids):
+    user_ids = list(dict.fromkeys(user_ids))
+    existing = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    found = [user_id for user_id in user_ids if user_id in existing]
+    not_found = [user_id for user_id in user_ids if user_id not in existing]
+    return found, not_found
+
+
+def touch_party(party):
+    Party.objects.filter(pk=party.pk).update(version=F('version') + 1)
+
+
+def add_members(party, user_ids):
+    Membership.objects.bulk_create([Membership(party_id=party.id, user_id=user_id) for user_id in user_ids],
+                                   ignore_conflicts=True)
+    if user_ids:
+        touch_party(party)
+
+
+def remove_members(party, user_ids):
+    if Membership.objects.filter(party_id=party.id, user_id__in=user_ids).delete()[0]:
+        touch_party(party)
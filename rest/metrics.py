@@ -0,0 +1,157 @@
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+HISTOGRAMS = {
+    'groupexp_request_duration_seconds': ("Wall time of a request", SECONDS),
+    'groupexp_request_sql_queries': ("SQL queries run by a request", QUERIES),
+    'groupexp_request_sql_duration_seconds': ("Time a request spent in SQL", SECONDS),
+    'groupexp_request_serializer_duration_seconds': ("Time a request spent serializing", SECONDS),
+    'groupexp_response_size_bytes': ("Size of a response body", BYTES),
+}
+REQUESTS_TOTAL = 'groupexp_requests_total'
+
+_current = ContextVar('rest_metrics_sample', default=None)
+_lock = threading.Lock()
+_histograms = {name: {} for name in HISTOGRAMS}
+_requests = {}
+
+
+class Sample:
+    __slots__ = ('queries', 'sql_time', 'serializer_time', 'serializing')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def start_sample():
+    sample = Sample()
+    return sample, _current.set(sample)
+
+
+def finish_sample(token, route, method, status, duration, size):
+    sample = _current.get()
+    _current.reset(token)
+    values = {
+        'groupexp_request_duration_seconds': duration,
+        'groupexp_request_sql_queries': sample.queries,
+        'groupexp_request_sql_duration_seconds': sample.sql_time,
+        'groupexp_request_serializer_duration_seconds': sample.serializer_time,
+        'groupexp_response_size_bytes': size,
+    }
+    with _lock:
+        for name, value in values.items():
+            histogram = _histograms[name].get(route)
+            if histogram is None:
+                histogram = _histograms[name][route] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+        key = (route, method, str(status))
+        _requests[key] = _requests.get(key, 0) + 1
+
+
+def record_query(execute, sql, params, many, context):
+    # installed on every connection, only counts while a request is sampled
+    sample = _current.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.sql_time += perf_counter() - start
+
+
+def timed_representation(represent, instance):
+    # only the outermost serializer is timed, nested ones are part of it
+    sample = _current.get()
+    if sample is None or sample.serializing:
+        return represent(instance)
+    sample.serializing = True
+    start = perf_counter()
+    try:
+        return represent(instance)
+    finally:
+        sample.serializing = False
+        sample.serializer_time += perf_counter() - start
+
+
+class TimedSerializerMixin:
+    def to_representation(self, instance):
+        return timed_representation(super().to_representation, instance)
+
+
+def route_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view = match.func
+    cls = getattr(view, 'cls', None)
+    actions = getattr(view, 'actions', None)
+    if cls is not None and actions:
+        return f"{cls.__name__}.{actions.get(request.method.lower(), request.method.lower())}"
+    if cls is not None:
+        return cls.__name__
+    return getattr(view, '__name__', view.__class__.__name__)
+
+
+def _labels(**labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """The collected metrics in the Prometheus text exposition format."""
+    lines = [f"# HELP {REQUESTS_TOTAL} Requests by route, method and status",
+             f"# TYPE {REQUESTS_TOTAL} counter"]
+    with _lock:
+        for (route, method, status), count in sorted(_requests.items()):
+            lines.append(f"{REQUESTS_TOTAL}{{{_labels(route=route, method=method, status=status)}}} {count}")
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for route, histogram in sorted(_histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{{{_labels(route=route, le=_number(bound))}}} {cumulative}")
+                lines.append(f"{name}_bucket{{{_labels(route=route, le='+Inf')}}} {histogram.count}")
+                lines.append(f"{name}_sum{{{_labels(route=route)}}} {_number(histogram.sum)}")
+                lines.append(f"{name}_count{{{_labels(route=route)}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        for histograms in _histograms.values():
+            histograms.clear()
+        _requests.clear()
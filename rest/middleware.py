@@ -0,0 +1,84 @@
+import asyncio
+from time import perf_counter
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from rest import metrics
+from rest.profiling import Capture, is_staff, wants_profile
+
+ASYNC_URLCONF = 'rest.async_urls'
+
+
+@sync_and_async_middleware
+def async_reads(get_response):
+    # WSGI keeps the plain sync views, under ASGI reads go through rest.async_urls
+    if not asyncio.iscoroutinefunction(get_response):
+        return get_response
+
+    async def middleware(request):
+        # a profiled request stays on the sync views, see request_profiler
+        if request.method in ('GET', 'HEAD') and not getattr(request, 'profiled', False):
+            request.urlconf = ASYNC_URLCONF
+        return await get_response(request)
+    return middleware
+
+
+def _observe(request, response, token, start):
+    size = 0 if response.streaming else len(response.content)
+    metrics.finish_sample(token, metrics.route_label(request), request.method, response.status_code,
+                          perf_counter() - start, size)
+
+
+@sync_and_async_middleware
+def request_metrics(get_response):
+    # outermost, so that the wall time covers every other middleware
+    if not settings.REQUEST_METRICS:
+        return get_response
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = perf_counter()
+            _, token = metrics.start_sample()
+            response = await get_response(request)
+            _observe(request, response, token, start)
+            return response
+        return middleware
+
+    def middleware(request):
+        start = perf_counter()
+        _, token = metrics.start_sample()
+        response = get_response(request)
+        _observe(request, response, token, start)
+        return response
+    return middleware
+
+
+def _profile(get_response, request):
+    if not is_staff(request):
+        return get_response(request)
+    with Capture(request) as capture:
+        response = get_response(request)
+    response['X-Profile-Id'] = capture.save(response)
+    return response
+
+
+@sync_and_async_middleware
+def request_profiler(get_response):
+    # X-Profile: 1 or ?profile=1 from a staff user runs the request under cProfile
+    if not asyncio.iscoroutinefunction(get_response):
+        def middleware(request):
+            if wants_profile(request):
+                return _profile(get_response, request)
+            return get_response(request)
+        return middleware
+
+    async def middleware(request):
+        if not wants_profile(request):
+            return await get_response(request)
+        # cProfile only sees its own thread, so the request is run in the
+        # thread of the sync views, where they come back to via async_to_sync
+        request.profiled = True
+        return await sync_to_async(_profile)(async_to_sync(get_response), request)
+    return middleware
@@ -0,0 +1,83 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:24
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_missing_tables(apps, schema_editor):
+    # Databases created before this migration was committed already have these
+    # tables, from migrations recorded under other names that were never shared.
+    existing = schema_editor.connection.introspection.table_names()
+    for name in ('DebtRecord', 'DebtFromChangeRecord', 'Contribution', 'Choice'):
+        model = apps.get_model('rest', name)
+        if model._meta.db_table not in existing:
+            schema_editor.create_model(model)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rest', '0013_profile'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='profile',
+                name='friends',
+                field=models.ManyToManyField(blank=True, related_name='followees', to='rest.Profile'),
+            ),
+            migrations.AlterField(
+                model_name='record',
+                name='price',
+                field=models.IntegerField(validators=[django.core.validators.MinValueValidator(1)]),
+            ),
+            migrations.AlterField(
+                model_name='record',
+                name='quantity',
+                field=models.IntegerField(validators=[django.core.validators.MinValueValidator(1)]),
+            ),
+            migrations.CreateModel(
+                name='DebtRecord',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('amount', models.IntegerField(validators=[django.core.validators.MinValueValidator(1)])),
+                    ('billing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='debts', to='rest.billing')),
+                    ('creditor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='loans', to=settings.AUTH_USER_MODEL)),
+                    ('debtor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='debts', to=settings.AUTH_USER_MODEL)),
+                ],
+            ),
+            migrations.CreateModel(
+                name='DebtFromChangeRecord',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('amount', models.IntegerField(validators=[django.core.validators.MinValueValidator(1)])),
+                    ('billing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='change', to='rest.billing')),
+                    ('creditor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='change_loans', to=settings.AUTH_USER_MODEL)),
+                ],
+            ),
+            migrations.CreateModel(
+                name='Contribution',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('contribution', models.IntegerField(validators=[django.core.validators.MinValueValidator(1)])),
+                    ('billing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contributions', to='rest.billing')),
+                    ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contributions', to=settings.AUTH_USER_MODEL)),
+                ],
+            ),
+            migrations.CreateModel(
+                name='Choice',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('quantity', models.IntegerField(validators=[django.core.validators.MinValueValidator(1)])),
+                    ('billing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='choices', to='rest.billing')),
+                    ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='choices', to='rest.record')),
+                    ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='choices', to=settings.AUTH_USER_MODEL)),
+                ],
+            ),
+        ]),
+        migrations.RunPython(create_missing_tables, migrations.RunPython.noop),
+    ]
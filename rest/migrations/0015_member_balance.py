@@ -0,0 +1,60 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from rest.settlement import split_amount
+
+
+def fill_balances(apps, schema_editor):
+    Billing = apps.get_model('rest', 'Billing')
+    Choice = apps.get_model('rest', 'Choice')
+    MemberBalance = apps.get_model('rest', 'MemberBalance')
+    for billing in Billing.objects.all():
+        balances = {}
+        for record in billing.records.all():
+            choices = list(Choice.objects.filter(record=record).order_by('id'))
+            if not choices:
+                continue
+            for choice, share in zip(choices, split_amount(record.price * record.quantity,
+                                                           [c.quantity for c in choices])):
+                choice.share = share
+                balances.setdefault(choice.user_id, MemberBalance(billing=billing, user_id=choice.user_id))
+                balances[choice.user_id].owed += share
+            Choice.objects.bulk_update(choices, ['share'])
+        for contribution in billing.contributions.all():
+            balances.setdefault(contribution.user_id, MemberBalance(billing=billing, user_id=contribution.user_id))
+            balances[contribution.user_id].contributed += contribution.contribution
+        MemberBalance.objects.bulk_create(balances.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rest', '0014_debt_records_choices_contributions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='choice',
+            name='share',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MemberBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owed', models.IntegerField(default=0)),
+                ('contributed', models.IntegerField(default=0)),
+                ('billing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balances', to='rest.billing')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balances', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='memberbalance',
+            constraint=models.UniqueConstraint(fields=('billing', 'user'), name='unique_member_balance'),
+        ),
+        migrations.RunPython(fill_balances, migrations.RunPython.noop),
+    ]
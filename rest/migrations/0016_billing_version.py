@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0015_member_balance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billing',
+            name='calculated_mode',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='billing',
+            name='calculated_version',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='billing',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
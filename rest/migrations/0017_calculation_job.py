@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0016_billing_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalculationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('mode', models.CharField(max_length=16)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.CharField(blank=True, max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('billing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calculation_jobs', to='rest.billing')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='calculationjob',
+            constraint=models.UniqueConstraint(fields=('billing', 'version', 'mode'), name='unique_calculation_job'),
+        ),
+    ]
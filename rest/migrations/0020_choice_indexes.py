@@ -0,0 +1,55 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:42
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+from rest.settlement import split_amount
+
+
+def drop_duplicate_choices(apps, schema_editor):
+    # keep the first pick of a record per user and re-split the records it touched
+    Choice = apps.get_model('rest', 'Choice')
+    MemberBalance = apps.get_model('rest', 'MemberBalance')
+    duplicates = (Choice.objects.values('user_id', 'record_id').annotate(first=Min('id'), count=Count('id'))
+                  .filter(count__gt=1).order_by())
+    records = set()
+    for duplicate in duplicates:
+        Choice.objects.filter(user_id=duplicate['user_id'], record_id=duplicate['record_id'])\
+            .exclude(id=duplicate['first']).delete()
+        records.add(duplicate['record_id'])
+    billings = set()
+    for record_id in records:
+        choices = list(Choice.objects.filter(record_id=record_id).select_related('record').order_by('id'))
+        record = choices[0].record
+        for choice, share in zip(choices, split_amount(record.price * record.quantity,
+                                                       [c.quantity for c in choices])):
+            choice.share = share
+        Choice.objects.bulk_update(choices, ['share'])
+        billings.add(record.billing_id)
+    for balance in MemberBalance.objects.filter(billing_id__in=billings):
+        balance.owed = Choice.objects.filter(billing_id=balance.billing_id, user_id=balance.user_id)\
+            .aggregate(total=Sum('share'))['total'] or 0
+        balance.save(update_fields=['owed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0019_revoked_token'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='choice',
+            index=models.Index(fields=['billing', 'user'], name='choice_billing_user'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['billing', 'product'], name='record_billing_product'),
+        ),
+        migrations.RunPython(drop_duplicate_choices, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='choice',
+            constraint=models.UniqueConstraint(fields=('user', 'record'), name='unique_user_choice'),
+        ),
+    ]
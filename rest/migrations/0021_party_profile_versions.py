@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0020_choice_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='party',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='friends_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
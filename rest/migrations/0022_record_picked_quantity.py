@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:53
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_picked_quantity(apps, schema_editor):
+    Choice = apps.get_model('rest', 'Choice')
+    Record = apps.get_model('rest', 'Record')
+    picked = Choice.objects.filter(record=OuterRef('pk')).values('record').annotate(total=Sum('quantity'))
+    Record.objects.update(picked_quantity=Coalesce(Subquery(picked.values('total')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest', '0021_party_profile_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='picked_quantity',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_picked_quantity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def set_journal_mode(mode):
+    def run(apps, schema_editor):
+        # persistent, so it is set once here instead of on every connection
+        if schema_editor.connection.vendor == 'sqlite':
+            schema_editor.execute(f"PRAGMA journal_mode = {mode}")
+    return run
+
+
+class Migration(migrations.Migration):
+    # the journal mode can't be changed inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('rest', '0023_calculation_job_claims'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_journal_mode('WAL'), set_journal_mode('DELETE')),
+    ]
@@ -4,9 +4,11 @@ from django.contrib.auth.models import User
 from rest_framework.exceptions import NotFound
 
 
-def get_object(klass, pk):
+def get_object(klass, pk, queryset=None):
+    if queryset is None:
+        queryset = klass.objects.all()
     try:
-        return klass.objects.get(pk=pk)
+        return queryset.get(pk=pk)
     except klass.DoesNotExist:
         raise NotFound(detail="Object of class {} with id {} is not found".format(klass.__name__, pk), code=404)
 
@@ -21,6 +23,7 @@ def get_user_by_name(username):
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     friends = models.ManyToManyField('self', symmetrical=False, related_name='followees', blank=True)
+    friends_version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.username}'s profile"
@@ -30,6 +33,7 @@ class Party(models.Model):
     name = models.CharField(max_length=32)
     host = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='hosted_parties')
     members = models.ManyToManyField(User, related_name='parties')
+    version = models.PositiveIntegerField(default=0)
 
     class Meta:
         verbose_name_plural = "Parties"
@@ -41,6 +45,9 @@ class Party(models.Model):
 class Billing(models.Model):
     party = models.OneToOneField(Party, on_delete=models.CASCADE)
     total = models.IntegerField(default=0)
+    version = models.PositiveIntegerField(default=0)
+    calculated_version = models.PositiveIntegerField(null=True, blank=True)
+    calculated_mode = models.CharField(max_length=16, blank=True)
 
     def __str__(self):
         return f"{self.party.name}" + "_bill"
@@ -61,6 +68,13 @@ class Record(models.Model):
     quantity = models.IntegerField(validators=[MinValueValidator(1)])
     price = models.IntegerField(validators=[MinValueValidator(1)])
     billing = models.ForeignKey(Billing, on_delete=models.CASCADE, related_name='records')
+    # sum of the choices' quantities, kept up to date by rest.balances
+    picked_quantity = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['billing', 'product'], name='record_billing_product'),
+        ]
 
     def __str__(self):
         return f"{self.product} - {self.price} - {self.quantity}"
@@ -71,6 +85,15 @@ class Choice(models.Model):
     quantity = models.IntegerField(validators=[MinValueValidator(1)])
     record = models.ForeignKey(Record, on_delete=models.CASCADE, related_name='choices')
     billing = models.ForeignKey(Billing, on_delete=models.CASCADE, related_name='choices')
+    share = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'record'], name='unique_user_choice'),
+        ]
+        indexes = [
+            models.Index(fields=['billing', 'user'], name='choice_billing_user'),
+        ]
 
     def __str__(self):
         return f"id:{self.id} {self.user.username} - {self.quantity} {self.record.product} in billing {self.billing.id}"
@@ -85,6 +108,59 @@ class Contribution(models.Model):
         return f"{self.user.username} - {self.contribution}"
 
 
+class MemberBalance(models.Model):
+    billing = models.ForeignKey(Billing, on_delete=models.CASCADE, related_name='balances')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balances')
+    owed = models.IntegerField(default=0)
+    contributed = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['billing', 'user'], name='unique_member_balance'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in billing {self.billing_id}: {self.contributed - self.owed}"
+
+
+class CalculationJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    SUPERSEDED = 'superseded'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'),
+                (SUPERSEDED, 'Superseded')]
+
+    billing = models.ForeignKey(Billing, on_delete=models.CASCADE, related_name='calculation_jobs')
+    version = models.PositiveIntegerField()
+    mode = models.CharField(max_length=16)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    result = models.JSONField(null=True, blank=True)
+    error = models.CharField(max_length=200, blank=True)
+    # set when a worker takes the job, a job running for too long is taken again
+    claimed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['billing', 'version', 'mode'], name='unique_calculation_job'),
+        ]
+
+    def __str__(self):
+        return f"calculation of billing {self.billing_id} v{self.version} - {self.status}"
+
+
+class RevokedToken(models.Model):
+    jti = models.CharField(max_length=32, unique=True)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.jti} until {self.expires}"
+
+
 class DebtRecord(models.Model):
     billing = models.ForeignKey(Billing, on_delete=models.CASCADE, related_name='debts')
     creditor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='loans')
@@ -103,59 +179,3 @@ class DebtFromChangeRecord(models.Model):
     def __str__(self):
         return f"{self.creditor} from change - {self.amount}"
 
-
-class Balance:
-    def __init__(self, user_list, total_check):
-        self.user_list = user_list
-        self.balances = [0 for _ in range(len(user_list))]
-        self.total_balance = -total_check
-
-    def addDebt(self, user, debt):
-        index = self.user_list.index(user)
-        self.balances[index] -= debt
-
-    def addContribution(self, user, contribution):
-        index = self.user_list.index(user)
-        self.balances[index] += contribution
-        self.total_balance += contribution
-
-    def final(self, billing):
-        debtors_list = []
-        creditors_list = []
-        for user, balance in zip(self.user_list, self.balances):
-            if balance < 0:
-                debtors_list.append((user, balance))
-            elif balance > 0:
-                creditors_list.append((user, balance))
-        debt_records = []
-        debt_from_change_records = []
-        while len(debtors_list) > 0 and len(creditors_list) > 0:
-            debtor, debt = debtors_list[-1]
-            creditor, credit = creditors_list[-1]
-            delta = debt + credit
-            if delta > 0:
-                debtors_list.pop()
-                debt_records.append(DebtRecord(billing=billing, debtor=debtor, creditor=creditor, amount=abs(debt)))
-                creditors_list[-1] = (creditor, delta)
-            elif delta < 0:
-                creditors_list.pop()
-                debt_records.append(DebtRecord(billing=billing, debtor=debtor, creditor=creditor, amount=credit))
-                debtors_list[-1] = (debtor, delta)
-            else:
-                debtors_list.pop()
-                creditors_list.pop()
-                debt_records.append(DebtRecord(billing=billing, debtor=debtor, creditor=creditor, amount=credit))
-
-        while len(creditors_list) > 0:
-            creditor, credit = creditors_list[-1]
-            debt_from_change_records.append(DebtFromChangeRecord(billing=billing, creditor=creditor, amount=credit))
-            creditors_list.pop()
-        return debt_records, debt_from_change_records
-
-    def __str__(self):
-        res = ""
-        for i in range(len(self.user_list)):
-            username = self.user_list[i].username
-            debt = self.balances[i]
-            res += f"{username}: {debt}\n"
-        return res
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+def paginated_response(request, queryset, serializer_class, view=None):
+    paginator = IdCursorPagination()
+    page = paginator.paginate_queryset(queryset, request, view)
+    serializer = serializer_class(page, many=True)
+    return paginator.get_paginated_response(serializer.data)
@@ -1,14 +1,16 @@
 from rest_framework import permissions
 
+from rest.membership import is_member
+
 
 class IsPartyHost(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return obj.host == request.user
+        return obj.host_id == request.user.id
 
 
 class IsPartyMember(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return request.user in obj.members.all()
+        return is_member(request, obj)
 
 
 class ViewSetActionPermissionMixin:
@@ -0,0 +1,131 @@
+import cProfile
+import io
+import json
+import pstats
+import secrets
+import time
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+EXPLAINED_QUERIES = 50
+STATS_LINES = 60
+
+
+def wants_profile(request):
+    return request.META.get('HTTP_X_PROFILE') == '1' or request.GET.get('profile') == '1'
+
+
+def is_staff(request):
+    # the view authenticates again later, this only decides whether to profile
+    drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        return bool(drf_request.user and drf_request.user.is_staff)
+    except APIException:
+        return False
+
+
+class Capture:
+    """Run a block under cProfile, recording every SQL query it runs."""
+
+    def __init__(self, request):
+        self.request = request
+        self.profile = cProfile.Profile()
+        self.queries = []
+
+    def __enter__(self):
+        self.wrapper = connection.execute_wrapper(self.record_query)
+        self.wrapper.__enter__()
+        self.started = time.perf_counter()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        self.duration = time.perf_counter() - self.started
+        self.wrapper.__exit__(*exc_info)
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql, 'params': None if many else params,
+                                 'duration': time.perf_counter() - start})
+
+    def explain(self):
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        plans = {}
+        for query in self.queries:
+            sql = query['sql']
+            if sql in plans or len(plans) >= EXPLAINED_QUERIES or not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(prefix + sql, query['params'])
+                    plans[sql] = [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+            except Exception as e:
+                plans[sql] = [f"EXPLAIN failed: {e}"]
+        for query in self.queries:
+            query['plan'] = plans.get(query['sql'])
+
+    def save(self, response):
+        """Store the capture in the ring buffer and return its id."""
+        self.explain()
+        stats = io.StringIO()
+        pstats.Stats(self.profile, stream=stats).sort_stats('cumulative').print_stats(STATS_LINES)
+        capture_id = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{secrets.token_hex(4)}"
+        details = {
+            'id': capture_id,
+            'created': datetime.utcnow().isoformat() + 'Z',
+            'method': self.request.method,
+            'path': self.request.get_full_path(),
+            'status': response.status_code,
+            'duration': self.duration,
+            'query_count': len(self.queries),
+            'query_duration': sum(query['duration'] for query in self.queries),
+            'queries': self.queries,
+            'stats': stats.getvalue(),
+        }
+        directory = capture_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.profile.dump_stats(directory / f"{capture_id}.prof")
+        (directory / f"{capture_id}.json").write_text(json.dumps(details, default=str))
+        _trim(directory)
+        return capture_id
+
+
+def capture_dir():
+    return Path(settings.PROFILE_CAPTURE_DIR)
+
+
+def _trim(directory):
+    for path in sorted(directory.glob('*.json'))[:-settings.PROFILE_CAPTURES_KEPT]:
+        path.unlink(missing_ok=True)
+        path.with_suffix('.prof').unlink(missing_ok=True)
+
+
+def list_captures():
+    """Summaries of the stored captures, newest first."""
+    captures = []
+    for path in sorted(capture_dir().glob('*.json'), reverse=True):
+        try:
+            details = json.loads(path.read_text())
+        except (OSError, ValueError):
+            # trimmed or still being written by another process
+            continue
+        details.pop('queries')
+        details.pop('stats')
+        captures.append(details)
+    return captures
+
+
+def capture_path(capture_id, suffix):
+    # ids are slugs, so they cannot leave the capture directory
+    path = capture_dir() / f"{capture_id}{suffix}"
+    return path if path.is_file() else None
@@ -0,0 +1,69 @@
+import re
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Exists, OuterRef, Q
+
+from rest.membership import Membership
+
+SEARCH_TABLE = 'rest_user_search'
+
+
+def index_user(user):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [user.id])
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} (rowid, username, email) VALUES (%s, %s, %s)",
+                       [user.id, user.username, user.email])
+
+
+def unindex_user(user):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [user.id])
+
+
+def _friend_ids(user):
+    return User.objects.filter(profile__followees__user_id=user.id).values('id')
+
+
+def _co_member_ids(user):
+    return Membership.objects.filter(
+        party_id__in=Membership.objects.filter(user_id=user.id).values('party_id')
+    ).values('user_id')
+
+
+def search_users(user, query, limit):
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return []
+    if connection.vendor != 'sqlite':
+        return _search_users_fallback(user, terms, limit)
+
+    # every term is matched as a prefix of a username or email token
+    match = " ".join(f'"{term}"*' for term in terms)
+    friends_sql, friends_params = _friend_ids(user).query.sql_with_params()
+    members_sql, members_params = _co_member_ids(user).query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s AND rowid != %s "
+            f"ORDER BY rowid IN ({friends_sql}) DESC, rowid IN ({members_sql}) DESC, rank LIMIT %s",
+            [match, user.id, *friends_params, *members_params, limit]
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    users = User.objects.in_bulk(ids)
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+def _search_users_fallback(user, terms, limit):
+    matches = Q()
+    for term in terms:
+        matches &= Q(username__istartswith=term) | Q(email__istartswith=term)
+    return list(
+        User.objects.filter(matches).exclude(id=user.id)
+        .annotate(is_friend=Exists(_friend_ids(user).filter(id=OuterRef('id'))),
+                  is_co_member=Exists(_co_member_ids(user).filter(user_id=OuterRef('id'))))
+        .order_by('-is_friend', '-is_co_member', 'username')[:limit]
+    )
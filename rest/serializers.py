@@ -1,6 +1,58 @@
+import copy
+
 from rest_framework import serializers
 from rest.models import *
-from django.db.models import Sum, F
+from rest.balances import adjust_picked_quantities, refresh_balances
+from rest.db import write_transaction
+from rest.events import RECORDS_UPDATED, publish_on_commit
+from rest.membership import add_members, find_users, touch_party
+from rest.metrics import TimedSerializerMixin, timed_representation
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F, Prefetch
+
+
+class EagerLoadingMixin:
+    # Related fields that are not rendered by a nested serializer but are
+    # still read by the serializer. Nested serializers add their own plans.
+    select_related_fields = []
+    prefetch_related_fields = []
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        select, prefetch = cls.loading_plan()
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    @classmethod
+    def setup_select_related(cls, queryset):
+        select, _ = cls.loading_plan()
+        return queryset.select_related(*select) if select else queryset
+
+    @classmethod
+    def loading_plan(cls):
+        select = list(cls.select_related_fields)
+        prefetch = list(cls.prefetch_related_fields)
+        for name, field in cls._declared_fields.items():
+            many = isinstance(field, serializers.ListSerializer)
+            child = field.child if many else field
+            if not isinstance(child, EagerLoadingMixin):
+                continue
+            source = field.source or name
+            if many:
+                queryset = child.setup_eager_loading(child.Meta.model.objects.all())
+                prefetch.append(Prefetch(source, queryset=queryset))
+                continue
+            child_select, child_prefetch = child.loading_plan()
+            select.append(source)
+            select.extend(f"{source}__{lookup}" for lookup in child_select)
+            for lookup in child_prefetch:
+                lookup = Prefetch(lookup) if isinstance(lookup, str) else copy.copy(lookup)
+                lookup.add_prefix(source)
+                prefetch.append(lookup)
+        return select, prefetch
 
 
 class UserCreateSerializer(serializers.ModelSerializer):
@@ -25,7 +77,15 @@ class UserCreateSerializer(serializers.ModelSerializer):
         return user
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserListSerializer(serializers.ListSerializer):
+    def validate(self, attrs):
+        _, not_found = find_users([user['id'] for user in attrs])
+        if not_found:
+            raise serializers.ValidationError("Users with ids {} don't exist".format(not_found))
+        return attrs
+
+
+class UserSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email']
@@ -34,8 +94,12 @@ class UserSerializer(serializers.ModelSerializer):
             'username': {'read_only': True},
             'email': {'read_only': True}
         }
+        list_serializer_class = UserListSerializer
 
     def validate_id(self, value):
+        if isinstance(self.parent, UserListSerializer):
+            # checked for the whole list at once
+            return value
         try:
             User.objects.get(pk=value)
         except User.DoesNotExist:
@@ -43,17 +107,37 @@ class UserSerializer(serializers.ModelSerializer):
         return value
 
 
-class RecordSerializer(serializers.ModelSerializer):
+class UserIdSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+
+
+class RefreshTokenSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
+
+
+class BatchRequestSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(choices=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+    path = serializers.CharField(max_length=200)
+    body = serializers.JSONField(required=False)
+
+
+class UserSearchSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=100)
+    limit = serializers.IntegerField(min_value=1, max_value=50, default=20)
+
+
+class RecordSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = Record
         fields = '__all__'
         extra_kwargs = {
             'billing': {'read_only': True},
-            'id': {'read_only': False}
+            'id': {'read_only': False},
+            'picked_quantity': {'read_only': True}
         }
 
 
-class DebtRecordSerializer(serializers.ModelSerializer):
+class DebtRecordSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = DebtRecord
         fields = "__all__"
@@ -62,7 +146,7 @@ class DebtRecordSerializer(serializers.ModelSerializer):
     creditor = UserSerializer()
 
 
-class DebtFromChangeRecordSerializer(serializers.ModelSerializer):
+class DebtFromChangeRecordSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = DebtFromChangeRecord
         fields = "__all__"
@@ -70,12 +154,31 @@ class DebtFromChangeRecordSerializer(serializers.ModelSerializer):
     creditor = UserSerializer()
 
 
-class ResultSerializer(serializers.Serializer):
-    debts = DebtRecordSerializer(many=True, read_only=True)
-    change = DebtFromChangeRecordSerializer(many=True, read_only=True)
+# A result is not always saved and bulk_create leaves the rows without ids
+# on SQLite, so results are rendered without them.
+class ResultDebtSerializer(DebtRecordSerializer):
+    class Meta(DebtRecordSerializer.Meta):
+        fields = ['debtor', 'creditor', 'amount', 'billing']
+
+
+class ResultChangeSerializer(DebtFromChangeRecordSerializer):
+    class Meta(DebtFromChangeRecordSerializer.Meta):
+        fields = ['creditor', 'amount', 'billing']
+
+
+class ResultSerializer(TimedSerializerMixin, serializers.Serializer):
+    debts = ResultDebtSerializer(many=True, read_only=True)
+    change = ResultChangeSerializer(many=True, read_only=True)
+
+
+class CalculationJobSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = CalculationJob
+        fields = ['id', 'billing', 'version', 'mode', 'status', 'result', 'error', 'created', 'updated']
+        read_only_fields = fields
 
 
-class ContributionSerializer(serializers.ModelSerializer):
+class ContributionSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = Contribution
         fields = "__all__"
@@ -86,36 +189,67 @@ class ContributionSerializer(serializers.ModelSerializer):
             'billing': {'read_only': True}
         }
 
+    select_related_fields = ['user']
+
     user = serializers.SlugRelatedField(slug_field='username', read_only=True)
 
 
-class ChoiceSerializer(serializers.ModelSerializer):
+class ChoiceListSerializer(serializers.ListSerializer):
+    @write_transaction()
+    def replace(self, billing, user_id):
+        # Makes the user's choices match the submitted ones with bulk statements
+        # and returns the ids of the records whose picks changed.
+        picks = {}
+        for item in self.validated_data:
+            if item['record']['id'] in picks:
+                raise serializers.ValidationError({"detail": "Each item can be picked only once"})
+            picks[item['record']['id']] = item['quantity']
+
+        if billing.records.filter(id__in=picks).count() != len(picks):
+            raise serializers.ValidationError({"detail": "No such record in billing"})
+
+        stored = {choice.record_id: choice
+                  for choice in Choice.objects.filter(billing=billing, user_id=user_id).only('id', 'record_id', 'quantity')}
+        deltas = {record_id: quantity - (stored[record_id].quantity if record_id in stored else 0)
+                  for record_id, quantity in picks.items()}
+        deltas.update((record_id, -choice.quantity) for record_id, choice in stored.items() if record_id not in picks)
+        exceeded = adjust_picked_quantities(deltas)
+        if exceeded:
+            # rolls back the adjustment together with the transaction
+            raise serializers.ValidationError({"detail": f"Quantity exceeds amount of {', '.join(exceeded)} left"})
+        created = [Choice(user_id=user_id, billing=billing, record_id=record_id, quantity=quantity)
+                   for record_id, quantity in picks.items() if record_id not in stored]
+        updated = []
+        for record_id, choice in stored.items():
+            if record_id in picks and choice.quantity != picks[record_id]:
+                choice.quantity = picks[record_id]
+                updated.append(choice)
+        deleted = [record_id for record_id in stored if record_id not in picks]
+
+        if deleted:
+            Choice.objects.filter(id__in=[stored[record_id].id for record_id in deleted]).delete()
+        Choice.objects.bulk_update(updated, ['quantity'], batch_size=500)
+        Choice.objects.bulk_create(created, batch_size=500)
+        return {choice.record_id for choice in created + updated} | set(deleted)
+
+
+class ChoiceSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = Choice
         fields = "__all__"
         extra_kwargs = {
             'id': {'read_only': True},
             'quantity': {'read_only': False},
-            'billing': {'read_only': True}
+            'billing': {'read_only': True},
+            'share': {'read_only': True}
         }
+        list_serializer_class = ChoiceListSerializer
 
     user = UserSerializer(read_only=True)
     record = RecordSerializer(read_only=False)
 
-    def create(self, validated_data):
-        user = validated_data.pop('user')
-        record = validated_data.pop('record')
-        billing = validated_data.pop('billing')
-        record_instance = get_object(Record, record['id'])
-        Choice.objects.create(
-            user=user,
-            record=record_instance,
-            billing=billing,
-            quantity=validated_data.pop('quantity')
-        )
-
 
-class BillingSerializer(serializers.ModelSerializer):
+class BillingSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     records = RecordSerializer(many=True)
     change = DebtFromChangeRecordSerializer(many=True, read_only=True)
     debts = DebtRecordSerializer(many=True, read_only=True)
@@ -124,32 +258,46 @@ class BillingSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Billing
-        fields = '__all__'
+        exclude = ['calculated_version', 'calculated_mode']
         extra_kwargs = {
             'total': {'read_only': True},
             'party': {'read_only': True},
+            'version': {'read_only': True},
         }
 
+    @write_transaction()
     def update(self, instance, validated_data):
-        records_list = validated_data['records']
-        all_records = instance.records.all()
-        records = []
-        for r in records_list:
-            if r['id'] == 0:
-                r.pop('id')
-            records.append(Record(**r, billing=instance))
-        for record in records:
-            record.save()
-        for record in all_records:
-            if record not in records:
-                record.delete()
-        total = instance.records.aggregate(total=Sum(F('quantity') * F('price')))
-        instance.total = total.get('total')
-        instance.save()
+        stored = {record.id: record for record in instance.records.all()}
+        created = []
+        updated = []
+        repriced = []
+        total = 0
+        for r in validated_data['records']:
+            record = stored.pop(r.pop('id'), None)
+            total += r['quantity'] * r['price']
+            if record is None:
+                created.append(Record(**r, billing=instance))
+                continue
+            if (record.quantity, record.price) != (r['quantity'], r['price']):
+                repriced.append(record.id)
+            if (record.product, record.quantity, record.price) != (r['product'], r['quantity'], r['price']):
+                record.product, record.quantity, record.price = r['product'], r['quantity'], r['price']
+                updated.append(record)
+
+        Record.objects.bulk_create(created)
+        Record.objects.bulk_update(updated, ['product', 'quantity', 'price'])
+        pickers = set()
+        if stored:
+            pickers.update(Choice.objects.filter(record_id__in=stored).values_list('user_id', flat=True))
+            Record.objects.filter(id__in=stored).delete()
+        instance.total = total
+        instance.save(update_fields=['total'])
+        refresh_balances(instance, record_ids=repriced, user_ids=pickers)
+        publish_on_commit(instance, RECORDS_UPDATED)
         return instance
 
 
-class PartySerializer(serializers.ModelSerializer):
+class PartySerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     members = UserSerializer(many=True, required=False)
     host = UserSerializer(read_only=True)
 
@@ -160,19 +308,14 @@ class PartySerializer(serializers.ModelSerializer):
             'billing': {'read_only': True}
         }
 
+    select_related_fields = ['billing']
+
+    @write_transaction()
     def create(self, validated_data):
         host = validated_data.get("host")
-        if "members" not in validated_data:
-            party = Party.objects.create(**validated_data)
-            party.members.add(host)
-            return party
-        members = validated_data.pop('members')
+        members = validated_data.pop('members', [])
         party = Party.objects.create(**validated_data)
-        party.members.add(host)
-        for m in members:
-            member_id = m['id']
-            member = get_object(User, member_id)
-            party.members.add(member)
+        add_members(party, [host.id] + [m['id'] for m in members])
         return party
 
     def update(self, instance, validated_data):
@@ -187,6 +330,114 @@ class PartySerializer(serializers.ModelSerializer):
                 host = get_object(User, host_id)
                 if host in instance.members:
                     instance.host = host
-        instance.save()
+        instance.save(update_fields=['name', 'host'])
+        touch_party(instance)
         return instance
 
+
+USER_VALUES = ['id', 'username', 'email']
+RECORD_VALUES = ['id', 'product', 'quantity', 'price', 'picked_quantity', 'billing']
+
+
+class ValuesSerializer:
+    """Read-only serializer building plain dicts from .values() rows.
+
+    Used by the hot GET endpoints in place of the model serializers, whose
+    output it reproduces exactly without DRF's per-field work.
+    """
+
+    def __init__(self, instance, many=False):
+        self.instance = instance
+        self.many = many
+        # one dict per user, shared by every place the user is rendered
+        self.users = {}
+
+    @property
+    def data(self):
+        data = timed_representation(self.to_representation, self.instance if self.many else [self.instance])
+        return data if self.many else data[0]
+
+    def user(self, row, prefix=''):
+        user_id = row[prefix + 'id']
+        if user_id is None:
+            return None
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = {name: row[prefix + name] for name in USER_VALUES}
+        return user
+
+    def choices(self, queryset):
+        values = (['id', 'quantity', 'share', 'billing'] + [f"user__{name}" for name in USER_VALUES]
+                  + [f"record__{name}" for name in RECORD_VALUES])
+        return [{
+            'id': row['id'],
+            'user': self.user(row, 'user__'),
+            'record': {name: row[f"record__{name}"] for name in RECORD_VALUES},
+            'quantity': row['quantity'],
+            'share': row['share'],
+            'billing': row['billing'],
+        } for row in queryset.values(*values)]
+
+
+class ChoiceReadSerializer(ValuesSerializer):
+    # renders a queryset of choices like ChoiceSerializer
+    def to_representation(self, choices):
+        return self.choices(choices)
+
+
+class BillingReadSerializer(ValuesSerializer):
+    # renders billings like BillingSerializer
+    def to_representation(self, billings):
+        ids = [billing.id for billing in billings]
+        debt_values = ['id', 'amount', 'billing'] + [f"creditor__{name}" for name in USER_VALUES]
+        records, change, debts, contributions, choices = ({billing_id: [] for billing_id in ids} for _ in range(5))
+        for row in Record.objects.filter(billing__in=ids).values(*RECORD_VALUES):
+            records[row['billing']].append(row)
+        for row in DebtFromChangeRecord.objects.filter(billing__in=ids).values(*debt_values):
+            change[row['billing']].append({'id': row['id'], 'creditor': self.user(row, 'creditor__'),
+                                           'amount': row['amount'], 'billing': row['billing']})
+        debt_values += [f"debtor__{name}" for name in USER_VALUES]
+        for row in DebtRecord.objects.filter(billing__in=ids).values(*debt_values):
+            debts[row['billing']].append({'id': row['id'], 'debtor': self.user(row, 'debtor__'),
+                                          'creditor': self.user(row, 'creditor__'), 'amount': row['amount'],
+                                          'billing': row['billing']})
+        for row in Contribution.objects.filter(billing__in=ids).values('id', 'user__username', 'contribution',
+                                                                       'billing'):
+            contributions[row['billing']].append({'id': row['id'], 'user': row['user__username'],
+                                                  'contribution': row['contribution'], 'billing': row['billing']})
+        for choice in self.choices(Choice.objects.filter(billing__in=ids)):
+            choices[choice['billing']].append(choice)
+        return [{
+            'id': billing.id,
+            'records': records[billing.id],
+            'change': change[billing.id],
+            'debts': debts[billing.id],
+            'contributions': contributions[billing.id],
+            'choices': choices[billing.id],
+            'total': billing.total,
+            'version': billing.version,
+            'party': billing.party_id,
+        } for billing in billings]
+
+
+class PartyReadSerializer(ValuesSerializer):
+    # renders parties like PartySerializer, expects PartySerializer.setup_select_related
+    def to_representation(self, parties):
+        members = {party.id: [] for party in parties}
+        for row in User.objects.filter(parties__in=members).values(*USER_VALUES, party=F('parties')):
+            members[row['party']].append(self.user(row))
+        data = []
+        for party in parties:
+            host = party.host
+            try:
+                billing = party.billing.id
+            except ObjectDoesNotExist:
+                billing = None
+            data.append({
+                'id': party.id,
+                'name': party.name,
+                'host': self.user({'id': host.id, 'username': host.username, 'email': host.email}),
+                'members': members[party.id],
+                'billing': billing,
+            })
+        return data
@@ -0,0 +1,204 @@
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rest.models import DebtRecord, DebtFromChangeRecord
+
+GREEDY = 'greedy'
+MIN_TRANSFERS = 'min'
+MODES = (GREEDY, MIN_TRANSFERS)
+
+# Exact minimum-transfer search is exponential in the number of parties left
+# after pairwise matching, above this size we fall back to greedy matching.
+MAX_EXACT_PARTIES = 12
+
+# Key of the virtual party that pays back the change when contributions exceed the total.
+CHANGE = None
+
+
+def split_amount(amount, weights):
+    """Split an integer amount proportionally to weights using largest remainder rounding."""
+    total_weight = sum(weights)
+    shares = []
+    remainders = []
+    for index, weight in enumerate(weights):
+        share, remainder = divmod(amount * weight, total_weight)
+        shares.append(share)
+        remainders.append((-remainder, index))
+    left = amount - sum(shares)
+    for _, index in sorted(remainders)[:left]:
+        shares[index] += 1
+    return shares
+
+
+def allocate(records, weights, totals):
+    """Split every record total between its choices in one batch.
+
+    records holds the record index of each choice (choices grouped by record),
+    weights the picked quantities and totals the price of each record. Returns
+    the share of every choice, rounded like split_amount within each record.
+    """
+    if numpy is None or not len(records):
+        shares = []
+        start = 0
+        for end in range(1, len(records) + 1):
+            if end == len(records) or records[end] != records[start]:
+                shares.extend(split_amount(totals[records[start]], weights[start:end]))
+                start = end
+        return shares
+
+    records = numpy.asarray(records, dtype=numpy.int64)
+    weights = numpy.asarray(weights, dtype=numpy.int64)
+    totals = numpy.asarray(totals, dtype=numpy.int64)
+    picked = numpy.zeros(len(totals), dtype=numpy.int64)
+    numpy.add.at(picked, records, weights)
+    shares, remainders = numpy.divmod(totals[records] * weights, picked[records])
+    allocated = numpy.zeros(len(totals), dtype=numpy.int64)
+    numpy.add.at(allocated, records, shares)
+    left = totals - allocated
+
+    # the cents left in each record go to the largest remainders first
+    positions = numpy.arange(len(records))
+    order = numpy.lexsort((positions, -remainders, records))
+    ranked = records[order]
+    rank = positions - numpy.searchsorted(ranked, ranked)
+    shares[order[rank < left[ranked]]] += 1
+    return shares.tolist()
+
+
+class Settlement:
+    def __init__(self, total_check=0):
+        self.balances = defaultdict(int)
+        self.total_balance = -total_check
+
+    def add_debt(self, user_id, debt):
+        self.balances[user_id] -= debt
+
+    def add_contribution(self, user_id, contribution):
+        self.balances[user_id] += contribution
+        self.total_balance += contribution
+
+    def transfers(self, mode=GREEDY):
+        if mode not in MODES:
+            raise ValueError(f"Unknown settlement mode {mode}")
+        parties = {user_id: balance for user_id, balance in self.balances.items() if balance != 0}
+        if self.total_balance > 0:
+            parties[CHANGE] = -self.total_balance
+        if mode == GREEDY:
+            return _settle_greedy(parties)
+        return _settle_min_transfers(parties)
+
+    def final(self, billing, users=None, mode=GREEDY):
+        users = users or {}
+        debt_records = []
+        debt_from_change_records = []
+        for debtor_id, creditor_id, amount in self.transfers(mode):
+            creditor = _user_kwargs('creditor', creditor_id, users)
+            if debtor_id is CHANGE:
+                debt_from_change_records.append(DebtFromChangeRecord(billing=billing, amount=amount, **creditor))
+            else:
+                debtor = _user_kwargs('debtor', debtor_id, users)
+                debt_records.append(DebtRecord(billing=billing, amount=amount, **debtor, **creditor))
+        return debt_records, debt_from_change_records
+
+    def __str__(self):
+        return "".join(f"{user_id}: {balance}\n" for user_id, balance in self.balances.items())
+
+
+def _user_kwargs(field, user_id, users):
+    if user_id in users:
+        return {field: users[user_id]}
+    return {f"{field}_id": user_id}
+
+
+def _sort_key(item):
+    user_id, balance = item
+    # the change party always settles last, as it did in the original algorithm
+    return user_id is CHANGE, -abs(balance), user_id or 0
+
+
+def _settle_greedy(parties):
+    debtors = sorted(((u, -b) for u, b in parties.items() if b < 0), key=_sort_key)
+    creditors = sorted(((u, b) for u, b in parties.items() if b > 0), key=_sort_key)
+    transfers = []
+    d = c = 0
+    while d < len(debtors) and c < len(creditors):
+        debtor, debt = debtors[d]
+        creditor, credit = creditors[c]
+        amount = min(debt, credit)
+        transfers.append((debtor, creditor, amount))
+        debtors[d] = (debtor, debt - amount)
+        creditors[c] = (creditor, credit - amount)
+        if debt == amount:
+            d += 1
+        if credit == amount:
+            c += 1
+    return transfers
+
+
+def _settle_min_transfers(parties):
+    # Every group of parties whose balances sum to zero can be settled with
+    # len(group) - 1 transfers, so the fewest transfers come from splitting
+    # the parties into as many zero-sum groups as possible.
+    transfers = []
+    creditors_by_amount = defaultdict(list)
+    for user_id, balance in sorted(parties.items(), key=_sort_key):
+        if balance > 0:
+            creditors_by_amount[balance].append(user_id)
+    rest = {}
+    for user_id, balance in sorted(parties.items(), key=_sort_key):
+        if balance < 0 and creditors_by_amount.get(-balance):
+            transfers.append((user_id, creditors_by_amount[-balance].pop(), -balance))
+        elif balance < 0:
+            rest[user_id] = balance
+    for amount, creditors in creditors_by_amount.items():
+        for user_id in creditors:
+            rest[user_id] = amount
+
+    if len(rest) > MAX_EXACT_PARTIES:
+        return transfers + _settle_greedy(rest)
+    for group in _zero_sum_groups(sorted(rest.items(), key=_sort_key)):
+        transfers.extend(_settle_greedy(dict(group)))
+    return transfers
+
+
+def _zero_sum_groups(items):
+    n = len(items)
+    if n == 0:
+        return []
+    full = (1 << n) - 1
+    sums = [0] * (full + 1)
+    groups = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = (mask & -mask).bit_length() - 1
+        sums[mask] = sums[mask & (mask - 1)] + items[low][1]
+        best = 0
+        bits = mask
+        while bits:
+            bit = bits & -bits
+            best = max(best, groups[mask ^ bit])
+            bits ^= bit
+        groups[mask] = best + (sums[mask] == 0)
+
+    # walk back from the full set, every zero-sum prefix closes a group
+    result = []
+    current = []
+    mask = full
+    while mask:
+        bits = mask
+        while bits:
+            bit = bits & -bits
+            if groups[mask ^ bit] + (sums[mask] == 0) == groups[mask]:
+                break
+            bits ^= bit
+        if sums[mask] == 0 and current:
+            result.append(current)
+            current = []
+        current.append(items[bit.bit_length() - 1])
+        mask ^= bit
+    result.append(current)
+    return result
+
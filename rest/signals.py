@@ -0,0 +1,31 @@
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from rest.db import configure_connection
+from rest.metrics import record_query
+from rest.search import index_user, unindex_user
+
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    configure_connection(connection)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(post_save, sender=User)
+def update_user_search(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and not {'username', 'email'} & set(update_fields)):
+        return
+    index_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def delete_user_search(sender, instance, **kwargs):
+    unindex_user(instance)
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.exceptions import APIException, NotAuthenticated, NotFound, PermissionDenied
+
+from rest.authentication import ACCESS, read_token
+from rest.events import Subscription, format_event
+from rest.membership import _is_member
+from rest.models import Billing
+
+EVENTS_PATH = re.compile(r'^/api/v2/billings/(?P<pk>[0-9]+)/events$')
+
+
+class EventStreamRouter:
+    # Django 3.2 can't stream from async code, so the event streams are
+    # served by plain ASGI in front of the Django application.
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            match = EVENTS_PATH.match(scope['path'])
+            if match:
+                return await billing_events(scope, receive, send, int(match['pk']))
+        return await self.application(scope, receive, send)
+
+
+def _token(scope):
+    headers = dict(scope['headers'])
+    auth = headers.get(b'authorization', b'').split()
+    if len(auth) == 2 and auth[0].lower() == b'bearer':
+        return auth[1].decode('latin1')
+    # EventSource can't set headers, so the token may come in the query string
+    tokens = parse_qs(scope.get('query_string', b'').decode('latin1')).get('token')
+    if not tokens:
+        raise NotAuthenticated()
+    return tokens[0]
+
+
+def _authorize(scope, billing_id):
+    try:
+        payload = read_token(_token(scope), ACCESS)
+        billing = Billing.objects.select_related('party').filter(pk=billing_id).first()
+        if billing is None:
+            raise NotFound(detail="Object of class Billing with id {} is not found".format(billing_id))
+        if not _is_member(payload['uid'], billing.party):
+            raise PermissionDenied()
+        return billing
+    finally:
+        close_old_connections()
+
+
+async def _send_error(send, exc):
+    body = json.dumps({'detail': str(exc.detail)}).encode()
+    await send({'type': 'http.response.start', 'status': exc.status_code,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def billing_events(scope, receive, send, billing_id):
+    # subscribe first so nothing is lost between the version check and the stream
+    with Subscription(billing_id) as subscription:
+        try:
+            billing = await sync_to_async(_authorize, thread_sensitive=False)(scope, billing_id)
+        except APIException as e:
+            return await _send_error(send, e)
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        body = format_event(0, 'connected', {'billing': billing.id, 'version': billing.version})
+        disconnected = asyncio.ensure_future(_disconnected(receive))
+        try:
+            while True:
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+                message = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait({message, disconnected}, timeout=settings.EVENT_STREAM_HEARTBEAT,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if message in done:
+                    body = message.result()
+                    continue
+                message.cancel()
+                if disconnected in done:
+                    return
+                body = b': ping\n\n'
+        finally:
+            disconnected.cancel()
@@ -1,3 +1,883 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import random
+import re
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import AsyncClient, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from rest.models import Party, Billing, Record, Choice, Contribution, CalculationJob, Profile
+
+from rest.authentication import RevokedAccessTokens, issue_tokens
+from rest.balances import rebuild_balances
+from rest.calculation import claim_job, run_job
+from rest.datagen import SKEWED, generate
+from rest.metrics import reset as reset_metrics
+from rest.renderers import FastJSONRenderer
+from rest.search import search_users
+from rest.serializers import (BillingReadSerializer, BillingSerializer, ChoiceReadSerializer, ChoiceSerializer,
+                              PartyReadSerializer, PartySerializer)
+from rest.sse import EventStreamRouter
+from rest.settlement import Settlement, allocate, split_amount, GREEDY, MIN_TRANSFERS, CHANGE
+
+
+def make_settlement(balances):
+    settlement = Settlement(-sum(balance for balance in balances.values() if balance < 0))
+    for user_id, balance in balances.items():
+        if balance > 0:
+            settlement.add_contribution(user_id, balance)
+        else:
+            settlement.add_debt(user_id, -balance)
+    return settlement
+
+
+class SplitAmountTest(SimpleTestCase):
+    def test_shares_add_up(self):
+        self.assertEqual(split_amount(100, [1, 1, 1]), [34, 33, 33])
+        self.assertEqual(split_amount(10, [3, 1]), [8, 2])
+        self.assertEqual(sum(split_amount(997, [7, 3, 5, 11])), 997)
+
+    def test_exact_split(self):
+        self.assertEqual(split_amount(90, [1, 2]), [30, 60])
+
+
+class AllocateTest(SimpleTestCase):
+    def test_matches_split_amount(self):
+        rng = random.Random(1)
+        records, weights, expected = [], [], []
+        totals = [rng.randint(1, 10000) for _ in range(50)]
+        for index, total in enumerate(totals):
+            picks = [rng.randint(1, 5) for _ in range(rng.randint(1, 7))]
+            records += [index] * len(picks)
+            weights += picks
+            expected += split_amount(total, picks)
+        self.assertEqual(allocate(records, weights, totals), expected)
+        with mock.patch('rest.settlement.numpy', None):
+            self.assertEqual(allocate(records, weights, totals), expected)
+        self.assertEqual(sum(expected), sum(totals))
+
+
+class SettlementTest(SimpleTestCase):
+    balances = {1: -30, 2: -20, 3: -10, 4: 20, 5: 40}
+
+    def test_settles_every_balance(self):
+        for mode in (GREEDY, MIN_TRANSFERS):
+            paid = dict.fromkeys(self.balances, 0)
+            for debtor, creditor, amount in make_settlement(self.balances).transfers(mode):
+                self.assertGreater(amount, 0)
+                paid[debtor] -= amount
+                paid[creditor] += amount
+            self.assertEqual(paid, self.balances)
+
+    def test_min_transfers_uses_zero_sum_groups(self):
+        self.assertEqual(len(make_settlement(self.balances).transfers(MIN_TRANSFERS)), 3)
+        settlement = make_settlement({1: -5, 2: -5, 3: 4, 4: 3, 5: 2, 6: 1})
+        self.assertEqual(len(settlement.transfers(GREEDY)), 5)
+        self.assertEqual(len(settlement.transfers(MIN_TRANSFERS)), 4)
+
+    def test_change_goes_to_creditors(self):
+        settlement = Settlement(50)
+        settlement.add_debt(1, 30)
+        settlement.add_debt(2, 20)
+        settlement.add_contribution(2, 100)
+        for mode in (GREEDY, MIN_TRANSFERS):
+            self.assertEqual(sorted(settlement.transfers(mode), key=str), [(1, 2, 30), (CHANGE, 2, 50)])
+
+
+class BillingFixtureMixin:
+    def create_billing(self, members=3, records=3):
+        cache.clear()
+        self.users = [User.objects.create_user(f"user{i}", f"user{i}@example.com", "password")
+                      for i in range(members)]
+        self.party = Party.objects.create(name="party", host=self.users[0])
+        self.party.members.add(*self.users)
+        self.billing = Billing.objects.create(party=self.party)
+        for i in range(records):
+            record = Record.objects.create(product=f"product{i}", quantity=2, price=100 + i, billing=self.billing)
+            for user in self.users:
+                Choice.objects.create(user=user, quantity=1, record=record, billing=self.billing)
+        self.billing.total = sum(r.price * r.quantity for r in self.billing.records.all())
+        self.billing.save()
+        Contribution.objects.create(user=self.users[0], contribution=self.billing.total, billing=self.billing)
+        rebuild_balances(self.billing)
+        self.client.force_authenticate(self.users[0])
+        return self.billing
+
+
+class CalculateTest(BillingFixtureMixin, APITestCase):
+    def calculate(self, **params):
+        return self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?{urlencode(params)}")
+
+    def test_debts_cover_the_total(self):
+        self.create_billing()
+        response = self.calculate()
+        self.assertEqual(response.status_code, 200)
+        owed = sum(split_amount(r.price * r.quantity, [1, 1, 1])[0] for r in self.billing.records.all())
+        self.assertEqual(sum(debt['amount'] for debt in response.data['debts']), self.billing.total - owed)
+        self.assertEqual(response.data['change'], [])
+        self.assertNotIn('id', response.data['debts'][0])
+
+    def test_query_count_does_not_depend_on_billing_size(self):
+        self.create_billing(members=3, records=2)
+        with self.assertNumQueries(13):
+            self.calculate()
+        Party.objects.all().delete()
+        User.objects.all().delete()
+        self.create_billing(members=8, records=40)
+        with self.assertNumQueries(13):
+            self.calculate()
+
+    def test_unpicked_record(self):
+        self.create_billing()
+        Record.objects.create(product="water", quantity=1, price=10, billing=self.billing)
+        Record.objects.create(product="bread", quantity=1, price=10, billing=self.billing)
+        response = self.calculate(mode=MIN_TRANSFERS)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'], "Some amount of water, bread is left unpicked")
+
+    def test_result_is_cached_per_version(self):
+        self.create_billing()
+        with self.captureOnCommitCallbacks(execute=True):
+            debts = self.calculate().data['debts']
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/v2/billings/{self.billing.id}/result")
+        self.assertEqual(response.data['debts'], debts)
+        cache.clear()
+        # read back from the saved rows
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(f"/api/v2/billings/{self.billing.id}/result")
+        self.assertEqual(response.data['debts'], debts)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.calculate().data['debts'], debts)
+
+        self.client.post("/api/v2/contributions", {"contribution": 50, "billing": self.billing.id}, format='json')
+        response = self.client.get(f"/api/v2/billings/{self.billing.id}/result")
+        self.assertEqual(response.data['change'][0]['amount'], 50)
+        self.assertFalse(self.billing.change.exists())
+        self.calculate()
+        self.assertEqual(self.billing.change.get().amount, 50)
+
+
+class MemberBalanceTest(BillingFixtureMixin, APITestCase):
+    def balances(self):
+        return sorted(self.billing.balances.exclude(owed=0, contributed=0)
+                      .values_list('user_id', 'owed', 'contributed'))
+
+    def assert_balances_match_rebuild(self):
+        balances = self.balances()
+        rebuild_balances(self.billing)
+        self.assertEqual(balances, self.balances())
+
+    def test_choices_keep_balances_up_to_date(self):
+        self.create_billing()
+        record = Record.objects.create(product="water", quantity=3, price=10, billing=self.billing)
+        response = self.client.post("/api/v2/choices", {"record": "water", "quantity": 2, "billing": self.billing.id},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.client.force_authenticate(self.users[1])
+        self.client.post("/api/v2/choices", {"record": "water", "quantity": 1, "billing": self.billing.id},
+                         format='json')
+        self.assert_balances_match_rebuild()
+
+        self.client.post(f"/api/v2/billings/{self.billing.id}/choices",
+                         [{"record": {"id": record.id, "product": "water", "quantity": 3, "price": 10}, "quantity": 1}],
+                         format='json')
+        self.assert_balances_match_rebuild()
+        self.client.delete(f"/api/v2/choices/{self.users[1].choices.first().id}")
+        self.assert_balances_match_rebuild()
+
+    def test_contributions_keep_balances_up_to_date(self):
+        self.create_billing()
+        response = self.client.post("/api/v2/contributions", {"contribution": 50, "billing": self.billing.id},
+                                    format='json')
+        balance = self.billing.balances.get(user=self.users[0])
+        self.assertEqual(balance.contributed, self.billing.total + 50)
+        self.client.delete(f"/api/v2/contributions/{response.data['id']}")
+        balance.refresh_from_db()
+        self.assertEqual(balance.contributed, self.billing.total)
+
+    def test_billing_update_keeps_balances_up_to_date(self):
+        self.create_billing()
+        records = [{"id": r.id, "product": r.product, "quantity": r.quantity, "price": r.price * 2}
+                   for r in self.billing.records.all()[1:]]
+        records.append({"id": 0, "product": "bread", "quantity": 1, "price": 5})
+        response = self.client.put(f"/api/v2/billings/{self.billing.id}", {"records": records}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assert_balances_match_rebuild()
+        self.assertEqual(sum(owed for _, owed, _ in self.balances()), (101 + 102) * 2 * 2)
+
+
+class ChoiceConstraintTest(BillingFixtureMixin, APITestCase):
+    def test_picking_twice_is_rejected_by_the_constraint(self):
+        self.create_billing()
+        version = self.billing.version
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/api/v2/choices", {"record": "product0", "quantity": 1,
+                                                            "billing": self.billing.id}, format='json')
+        self.assertEqual(response.status_code, 400)
+        # no read-then-write, the insert itself is rejected
+        self.assertFalse([q for q in queries if q['sql'].startswith('SELECT') and 'FROM "rest_choice"' in q['sql']])
+        self.assertEqual(self.users[0].choices.count(), 3)
+        self.billing.refresh_from_db()
+        self.assertEqual(self.billing.version, version)
+
+    def test_duplicate_records_in_bulk_update_keep_old_choices(self):
+        self.create_billing()
+        record = self.billing.records.first()
+        data = {"record": {"id": record.id, "product": record.product, "quantity": 2, "price": record.price},
+                "quantity": 1}
+        response = self.client.post(f"/api/v2/billings/{self.billing.id}/choices", [data, data], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.users[0].choices.count(), 3)
+
+
+class BulkChoicesTest(BillingFixtureMixin, APITestCase):
+    def picks(self, quantity=1):
+        return [{"record": {"id": r.id, "product": r.product, "quantity": r.quantity, "price": r.price},
+                 "quantity": quantity} for r in self.billing.records.all()]
+
+    def test_resubmitting_costs_constant_statements(self):
+        self.create_billing(members=1, records=200)
+        picks = self.picks()
+        url = f"/api/v2/billings/{self.billing.id}/choices"
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.post(url, picks, format='json').status_code, 200)
+        self.assertLess(len(queries), 10)
+
+        picks[0]["quantity"] = 2
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.post(url, picks[:150], format='json').status_code, 200)
+        self.assertLess(len(queries), 25)
+        self.assertEqual(sorted(self.users[0].choices.values_list('quantity', flat=True)), [1] * 149 + [2])
+        self.assertEqual(sum(self.billing.balances.values_list('owed', flat=True)),
+                         sum(Choice.objects.filter(billing=self.billing).values_list('share', flat=True)))
+
+    def test_quantity_is_checked_against_what_is_left(self):
+        self.create_billing(members=2, records=1)
+        response = self.client.post(f"/api/v2/billings/{self.billing.id}/choices", self.picks(2), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'], "Quantity exceeds amount of product0 left")
+        self.assertEqual(self.users[0].choices.get().quantity, 1)
+
+
+class PickedQuantityTest(BillingFixtureMixin, APITestCase):
+    def test_picked_quantity_follows_choices(self):
+        self.create_billing(members=2, records=2)
+        record = Record.objects.create(product="water", quantity=3, price=10, billing=self.billing)
+        data = {"record": "water", "quantity": 2, "billing": self.billing.id}
+        self.assertEqual(self.client.post("/api/v2/choices", data, format='json').status_code, 200)
+        self.client.force_authenticate(self.users[1])
+        response = self.client.post("/api/v2/choices", data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'], "Quantity exceeds amount of product left")
+        self.assertFalse(self.users[1].choices.filter(record=record).exists())
+
+        picks = [{"record": {"id": r.id, "product": r.product, "quantity": r.quantity, "price": r.price},
+                  "quantity": 1} for r in self.billing.records.all()]
+        self.client.post(f"/api/v2/billings/{self.billing.id}/choices", picks, format='json')
+        self.client.delete(f"/api/v2/choices/{self.users[1].choices.get(record__product='product0').id}")
+        picked = dict(self.billing.records.values_list('product', 'picked_quantity'))
+        self.assertEqual(picked, {"product0": 1, "product1": 2, "water": 3})
+
+        response = self.client.get(f"/api/v2/billings/{self.billing.id}")
+        self.assertEqual([r['picked_quantity'] for r in response.data['records']], [1, 2, 3])
+        rebuild_balances(self.billing)
+        self.assertEqual(dict(self.billing.records.values_list('product', 'picked_quantity')), picked)
+
+
+class BatchTest(BillingFixtureMixin, APITestCase):
+    def test_bill_entry_session_in_one_request(self):
+        self.create_billing(members=2, records=1)
+        records = [{"id": r.id, "product": r.product, "quantity": r.quantity, "price": r.price}
+                   for r in self.billing.records.all()]
+        records.append({"id": 0, "product": "bread", "quantity": 1, "price": 5})
+        response = self.client.post("/api/v2/batch", [
+            {"method": "PUT", "path": f"billings/{self.billing.id}", "body": {"records": records}},
+            {"method": "POST", "path": "choices",
+             "body": {"record": "bread", "quantity": 1, "billing": self.billing.id}},
+            {"method": "POST", "path": "/api/v2/contributions",
+             "body": {"contribution": 5, "billing": self.billing.id}},
+            {"method": "POST", "path": f"billings/{self.billing.id}/calculate?mode=min"},
+        ], format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertTrue(response.data['committed'])
+        self.assertEqual([r['status'] for r in response.data['responses']], [200, 200, 200, 200])
+        self.assertEqual(response.data['responses'][3]['body']['change'], [])
+        self.assertEqual(self.billing.contributions.count(), 2)
+
+    def test_failure_rolls_everything_back(self):
+        self.create_billing(members=1, records=1)
+        version = self.billing.version
+        response = self.client.post("/api/v2/batch", [
+            {"method": "POST", "path": "contributions", "body": {"contribution": 5, "billing": self.billing.id}},
+            {"method": "POST", "path": "choices", "body": {"record": "nothing", "quantity": 1,
+                                                          "billing": self.billing.id}},
+            {"method": "POST", "path": f"billings/{self.billing.id}/calculate"},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.data['committed'])
+        self.assertEqual(len(response.data['responses']), 2)
+        self.assertEqual(self.billing.contributions.count(), 1)
+        self.billing.refresh_from_db()
+        self.assertEqual(self.billing.version, version)
+
+    def test_only_router_routes_are_batched(self):
+        self.create_billing(members=1, records=1)
+        response = self.client.post("/api/v2/batch", [{"method": "POST", "path": "batch", "body": []}],
+                                    format='json')
+        self.assertEqual(response.status_code, 404)
+
+
+class CalculationJobTest(BillingFixtureMixin, APITestCase):
+    def test_jobs_are_coalesced_and_processed(self):
+        self.create_billing()
+        url = f"/api/v2/billings/{self.billing.id}/calculate?async=1"
+        job = self.client.post(url).data
+        self.assertEqual(job['status'], CalculationJob.PENDING)
+        self.assertEqual(self.client.post(url).data['id'], job['id'])
+
+        call_command('calculation_worker', once=True, stdout=StringIO())
+        response = self.client.get(f"/api/v2/billings/{self.billing.id}/calculation-jobs/{job['id']}")
+        self.assertEqual(response.data['status'], CalculationJob.DONE)
+        self.assertEqual(len(response.data['result']['debts']), 2)
+        self.assertEqual(self.billing.debts.count(), 2)
+
+    def test_failed_job_reports_error(self):
+        self.create_billing()
+        Record.objects.create(product="water", quantity=1, price=10, billing=self.billing)
+        job = self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?async=1").data
+        call_command('calculation_worker', once=True, stdout=StringIO())
+        response = self.client.get(f"/api/v2/billings/{self.billing.id}/calculation-jobs/{job['id']}")
+        self.assertEqual(response.data['status'], CalculationJob.FAILED)
+        self.assertEqual(response.data['error'], "Some amount of water is left unpicked")
+        # the billing has to change first, submitting it again keeps the failure
+        self.assertEqual(self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?async=1").data['status'],
+                         CalculationJob.FAILED)
+    def test_job_of_an_old_version_is_superseded(self):
+        self.create_billing()
+        job = self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?async=1").data
+        self.client.post("/api/v2/contributions", {"contribution": 50, "billing": self.billing.id}, format='json')
+        call_command('calculation_worker', once=True, stdout=StringIO())
+        job = CalculationJob.objects.get(pk=job['id'])
+        self.assertEqual(job.status, CalculationJob.SUPERSEDED)
+        self.assertIsNone(job.result)
+
+    def test_stale_job_is_claimed_again(self):
+        self.create_billing()
+        job = self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?async=1").data
+        self.assertEqual(claim_job().id, job['id'])
+        self.assertIsNone(claim_job())
+        CalculationJob.objects.filter(pk=job['id']).update(claimed=timezone.now() - datetime.timedelta(hours=1))
+        job = claim_job()
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(run_job(job).status, CalculationJob.DONE)
+
+    def test_transient_failure_is_retried(self):
+        self.create_billing()
+        self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?async=1")
+        with mock.patch('rest.calculation.get_result', side_effect=OperationalError("database is locked")):
+            job = run_job(claim_job())
+        self.assertEqual(job.status, CalculationJob.PENDING)
+        self.assertEqual(run_job(claim_job()).status, CalculationJob.DONE)
+
+        with override_settings(CALCULATION_JOB_ATTEMPTS=1):
+            self.client.post("/api/v2/contributions", {"contribution": 50, "billing": self.billing.id}, format='json')
+            self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?async=1")
+            with mock.patch('rest.calculation.get_result', side_effect=OperationalError("database is locked")):
+                failed = run_job(claim_job())
+            self.assertEqual(failed.status, CalculationJob.FAILED)
+            job = self.client.post(f"/api/v2/billings/{self.billing.id}/calculate?async=1").data
+            self.assertEqual((job['id'], job['status']), (failed.id, CalculationJob.PENDING))
+            self.assertEqual(run_job(claim_job()).status, CalculationJob.DONE)
+
+
+class DataGeneratorTest(APITestCase):
+    def test_generated_billings_can_be_calculated(self):
+        billings = generate(parties=4, members=(2, 6), records=(1, 10), friends=(0, 3), distribution=SKEWED)
+        for billing in billings:
+            self.client.force_authenticate(billing.party.host)
+            response = self.client.post(f"/api/v2/billings/{billing.id}/calculate")
+            self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(len(search_users(billings[0].party.host, "gen", 50)), User.objects.count() - 1)
+
+
+class EagerLoadingTest(BillingFixtureMixin, APITestCase):
+    def assert_constant_queries(self, url, queries):
+        self.create_billing(members=2, records=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/api/v2/billings/{self.billing.id}/calculate")
+        with self.assertNumQueries(queries):
+            self.client.get(url.format(billing=self.billing, party=self.party))
+        Party.objects.all().delete()
+        User.objects.all().delete()
+        self.create_billing(members=6, records=20)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/api/v2/billings/{self.billing.id}/calculate")
+        with self.assertNumQueries(queries):
+            self.client.get(url.format(billing=self.billing, party=self.party))
+
+    def test_billing_retrieve(self):
+        self.assert_constant_queries("/api/v2/billings/{billing.id}", 6)
+
+    def test_party_retrieve(self):
+        self.assert_constant_queries("/api/v2/parties/{party.id}", 2)
+
+    def test_party_list(self):
+        self.assert_constant_queries("/api/v2/parties", 3)
+
+
+class ReadSerializerTest(APITestCase):
+    def test_output_matches_model_serializers(self):
+        billings = generate(parties=4, members=(2, 6), records=(1, 15), friends=(0, 0), seed=5)
+        for billing in billings:
+            self.client.force_authenticate(billing.party.host)
+            self.client.post(f"/api/v2/billings/{billing.id}/calculate")
+        Record.objects.filter(billing=billings[0]).update(product="line\u2028break")
+        render = JSONRenderer().render
+
+        for billing in Billing.objects.select_related('party'):
+            self.assertEqual(render(BillingReadSerializer(billing).data), render(BillingSerializer(billing).data))
+            choices = billing.choices.all()
+            self.assertEqual(render(ChoiceReadSerializer(choices, many=True).data),
+                             render(ChoiceSerializer(choices, many=True).data))
+        parties = list(PartySerializer.setup_select_related(Party.objects.all()))
+        self.assertEqual(render(PartyReadSerializer(parties, many=True).data),
+                         render(PartySerializer(parties, many=True).data))
+
+
+class FastJSONRendererTest(SimpleTestCase):
+    data = {"text": "line\u2028break\u2029 – ünïcode", "when": datetime.datetime(2022, 5, 1, 12, 30, 5, 123456),
+            "day": datetime.date(2022, 5, 1), "amount": Decimal("1.50"), 1: [None, True, (1, 2)]}
+
+    def test_output_matches_json_renderer(self):
+        self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+        self.assertIn(b'\\u2028', FastJSONRenderer().render(self.data))
+        self.assertEqual(FastJSONRenderer().render(self.data, 'application/json; indent=4'),
+                         JSONRenderer().render(self.data, 'application/json; indent=4'))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_falls_back_without_orjson(self):
+        with mock.patch('rest.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+        with self.assertRaises(TypeError):
+            FastJSONRenderer().render({"value": object()})
+
+
+class BillingUpdateTest(BillingFixtureMixin, APITestCase):
+    def update(self, records):
+        return self.client.put(f"/api/v2/billings/{self.billing.id}", {"records": records}, format='json')
+
+    def submitted(self, size):
+        records = [{"id": r.id, "product": r.product, "quantity": r.quantity, "price": r.price + 1}
+                   for r in self.billing.records.all()[:size]]
+        return records + [{"id": 0, "product": f"new{i}", "quantity": 1, "price": 5} for i in range(size)]
+
+    def test_update_applies_diff(self):
+        self.create_billing(records=4)
+        kept = list(self.billing.records.all()[:2])
+        response = self.update(self.submitted(2))
+        self.assertEqual(response.status_code, 200)
+        records = {r.product: r for r in self.billing.records.all()}
+        self.assertEqual(sorted(records), ["new0", "new1", "product0", "product1"])
+        self.assertEqual([records[r.product].id for r in kept], [r.id for r in kept])
+        self.billing.refresh_from_db()
+        self.assertEqual(self.billing.total, sum(r.quantity * r.price for r in records.values()))
+        self.assertEqual(sum(self.billing.balances.values_list('owed', flat=True)), (101 + 102) * 2)
+
+    def test_statement_count_does_not_depend_on_record_count(self):
+        counts = []
+        for size in (2, 50):
+            self.create_billing(records=size * 2)
+            with CaptureQueriesContext(connection) as queries:
+                self.update(self.submitted(size))
+            counts.append(len([q for q in queries if not q['sql'].startswith('SELECT')]))
+            Party.objects.all().delete()
+            User.objects.all().delete()
+        self.assertEqual(counts[0], counts[1])
+
+
+class MembershipTest(BillingFixtureMixin, APITestCase):
+    def test_membership_check_is_cached(self):
+        self.create_billing(members=2, records=1)
+        url = f"/api/v2/billings/{self.billing.id}/choices"
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.client.get(url)
+        self.assertEqual(len([q for q in queries if 'rest_party_members' in q['sql']]), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertEqual(len([q for q in queries if 'rest_party_members' in q['sql']]), 0)
+
+    def test_ban_invalidates_cached_membership(self):
+        self.create_billing(members=2, records=1)
+        url = f"/api/v2/billings/{self.billing.id}/choices"
+        self.client.force_authenticate(self.users[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.force_authenticate(self.users[0])
+        # the ban leaves the cache alone, like one handled by another worker process
+        with mock.patch('rest.membership.cache.delete_many') as delete_many:
+            self.client.delete(f"/api/v2/parties/{self.party.id}/ban", [{"id": self.users[1].id}], format='json')
+        delete_many.assert_not_called()
+        self.client.force_authenticate(self.users[1])
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_invite_in_bulk(self):
+        self.create_billing(members=1, records=1)
+        guests = [User.objects.create_user(f"guest{i}", f"guest{i}@example.com", "password") for i in range(30)]
+        ids = [{"id": user.id} for user in guests] + [{"id": 9999}]
+        with self.assertNumQueries(5):
+            response = self.client.post(f"/api/v2/parties/{self.party.id}/invite", ids, format='json')
+        self.assertEqual(response.data['not_found'], [9999])
+        self.assertEqual(self.party.members.count(), 31)
+
+        response = self.client.delete(f"/api/v2/parties/{self.party.id}/ban", ids[:10], format='json')
+        self.assertEqual(response.data['not_found'], [])
+        self.assertEqual(self.party.members.count(), 21)
+
+    def test_host_cannot_be_banned(self):
+        self.create_billing(members=2, records=1)
+        response = self.client.delete(f"/api/v2/parties/{self.party.id}/ban",
+                                      [{"id": self.users[1].id}, {"id": self.users[0].id}], format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.party.members.count(), 2)
+
+    def test_create_party_with_members(self):
+        self.create_billing(members=3, records=1)
+        members = [{"id": user.id} for user in self.users[1:]]
+        response = self.client.post("/api/v2/parties", {"name": "new", "members": members}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Party.objects.get(name="new").members.count(), 3)
+        response = self.client.post("/api/v2/parties", {"name": "bad", "members": [{"id": 9999}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ConditionalRequestTest(BillingFixtureMixin, APITestCase):
+    def assert_not_modified(self, url, queries):
+        with self.captureOnCommitCallbacks(execute=True):
+            etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        return etag
+
+    def test_billing_etag_follows_version(self):
+        self.create_billing()
+        url = f"/api/v2/billings/{self.billing.id}"
+        etag = self.assert_not_modified(url, 1)
+        self.client.post(f"/api/v2/billings/{self.billing.id}/calculate")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_billing_update_honours_if_match(self):
+        self.create_billing()
+        url = f"/api/v2/billings/{self.billing.id}"
+        etag = self.client.get(url)['ETag']
+        records = [{"id": r.id, "product": r.product, "quantity": r.quantity, "price": r.price}
+                   for r in self.billing.records.all()]
+        response = self.client.put(url, {"records": records}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.put(url, {"records": records[1:]}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.billing.records.count(), 3)
+
+    def test_party_etags_follow_membership(self):
+        self.create_billing()
+        url = f"/api/v2/parties/{self.party.id}"
+        etag = self.assert_not_modified(url, 1)
+        list_etag = self.assert_not_modified("/api/v2/parties", 1)
+        guest = User.objects.create_user("guest", "guest@example.com", "password")
+        self.client.post(f"/api/v2/parties/{self.party.id}/invite", [{"id": guest.id}], format='json')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get("/api/v2/parties", HTTP_IF_NONE_MATCH=list_etag).status_code, 200)
+
+    def test_friends_etag_follows_friend_list(self):
+        self.create_billing()
+        for user in self.users:
+            Profile.objects.create(user=user)
+        etag = self.assert_not_modified("/api/v2/users/me/friends", 1)
+        self.client.post("/api/v2/users/me/friends", [{"id": self.users[1].id}], format='json')
+        response = self.client.get("/api/v2/users/me/friends", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+
+
+class RequestMetricsTest(BillingFixtureMixin, APITestCase):
+    def setUp(self):
+        reset_metrics()
+
+    def test_requests_are_aggregated_by_route(self):
+        self.create_billing()
+        self.client.get(f"/api/v2/billings/{self.billing.id}")
+        self.client.post(f"/api/v2/billings/{self.billing.id}/calculate")
+        self.client.post(f"/api/v2/billings/{self.billing.id}/calculate")
+        self.users[0].is_staff = True
+        self.users[0].save()
+
+        response = self.client.get("/api/v2/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.decode().splitlines()
+        self.assertIn('groupexp_requests_total{route="BillingViewSet.calculate",method="POST",status="200"} 2',
+                      lines)
+        self.assertIn('groupexp_request_duration_seconds_count{route="BillingViewSet.calculate"} 2', lines)
+        self.assertIn('groupexp_request_sql_queries_bucket{route="BillingViewSet.retrieve",le="+Inf"} 1', lines)
+        samples = {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in lines if line[0] != '#'}
+        self.assertGreater(samples['groupexp_request_sql_queries_sum{route="BillingViewSet.retrieve"}'], 0)
+        self.assertGreater(samples['groupexp_request_serializer_duration_seconds_sum{route="BillingViewSet.retrieve"}'],
+                           0)
+        self.assertGreater(samples['groupexp_response_size_bytes_sum{route="BillingViewSet.retrieve"}'], 0)
+
+    def test_metrics_are_staff_only(self):
+        self.create_billing(members=1, records=1)
+        self.assertEqual(self.client.get("/api/v2/metrics").status_code, 403)
+
+
+class ProfilerTest(BillingFixtureMixin, APITestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(PROFILE_CAPTURE_DIR=directory.name, PROFILE_CAPTURES_KEPT=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_staff_request_is_captured(self):
+        self.create_billing()
+        self.users[0].is_staff = True
+        self.users[0].save()
+        response = self.client.get(f"/api/v2/billings/{self.billing.id}", HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        capture_id = response['X-Profile-Id']
+
+        self.assertEqual([capture['id'] for capture in self.client.get("/api/v2/profiles").data], [capture_id])
+        details = self.client.get(f"/api/v2/profiles/{capture_id}").data
+        self.assertEqual(details['path'], f"/api/v2/billings/{self.billing.id}")
+        self.assertEqual(details['query_count'], len(details['queries']))
+        self.assertTrue(any(query['plan'] for query in details['queries']))
+        self.assertIn('cumulative', details['stats'])
+        download = self.client.get(f"/api/v2/profiles/{capture_id}/download")
+        self.assertEqual(download.status_code, 200)
+        self.assertTrue(b''.join(download.streaming_content))
+
+    def test_ring_buffer_keeps_newest(self):
+        self.create_billing(members=1, records=1)
+        self.users[0].is_staff = True
+        self.users[0].save()
+        ids = [self.client.get(f"/api/v2/billings/{self.billing.id}?profile=1")['X-Profile-Id'] for _ in range(3)]
+        self.assertEqual([capture['id'] for capture in self.client.get("/api/v2/profiles").data], ids[:0:-1])
+        self.assertEqual(self.client.get(f"/api/v2/profiles/{ids[0]}").status_code, 404)
+
+    def test_other_users_are_not_profiled(self):
+        self.create_billing(members=1, records=1)
+        response = self.client.get(f"/api/v2/billings/{self.billing.id}", HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Profile-Id'))
+        self.assertEqual(self.client.get("/api/v2/profiles").status_code, 403)
+
+
+class PaginationTest(BillingFixtureMixin, APITestCase):
+    def collect(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 4)
+            ids += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_users_are_paged_by_id(self):
+        self.create_billing(members=10, records=1)
+        self.assertEqual(self.collect("/api/v2/users_all?page_size=4"), [user.id for user in self.users])
+
+    def test_friends_are_paged(self):
+        self.create_billing(members=6, records=1)
+        for user in self.users:
+            Profile.objects.create(user=user)
+        self.client.post("/api/v2/users/me/friends", [{"id": user.id} for user in self.users], format='json')
+        self.assertEqual(self.collect("/api/v2/users/me/friends?page_size=4"), [user.id for user in self.users[1:]])
+
+    def test_contributions_are_paged(self):
+        self.create_billing(members=2, records=1)
+        for amount in range(1, 6):
+            Contribution.objects.create(user=self.users[0], contribution=amount, billing=self.billing)
+        contributions = list(self.users[0].contributions.values_list('id', flat=True))
+        self.assertEqual(self.collect("/api/v2/contributions?page_size=4"), contributions)
+        self.assertEqual(self.collect(f"/api/v2/billings/{self.billing.id}/contributions?page_size=4"), contributions)
+
+
+class UserSearchTest(BillingFixtureMixin, APITestCase):
+    def search(self, q, **params):
+        response = self.client.get("/api/v2/users/search", {"q": q, **params})
+        self.assertEqual(response.status_code, 200)
+        return [user['username'] for user in response.data]
+
+    def test_prefix_search_ranks_friends_and_co_members_first(self):
+        self.create_billing(members=2, records=1)
+        stranger = User.objects.create_user("alex_stranger", "a.stranger@example.com", "password")
+        friend = User.objects.create_user("alex_friend", "friend@example.com", "password")
+        self.users[1].username = "alex_member"
+        self.users[1].save()
+        for user in (self.users[0], friend):
+            Profile.objects.create(user=user)
+        self.users[0].profile.friends.add(friend.profile)
+
+        self.assertEqual(self.search("ale"), ["alex_friend", "alex_member", "alex_stranger"])
+        self.assertEqual(self.search("alex str"), ["alex_stranger"])
+        self.assertEqual(self.search("exam", limit=1), ["alex_friend"])
+
+        stranger.delete()
+        self.assertEqual(self.search("stranger"), [])
+        self.assertEqual(self.search("user0"), [])
+
+
+class SignedTokenTest(BillingFixtureMixin, APITestCase):
+    def login(self):
+        self.client.force_authenticate(None)
+        response = self.client.post("/api/v2/login", {"email": "user0@example.com", "password": "password"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('auth_token', response.data)
+        return response.data
+
+    def test_access_token_authenticates_without_user_query(self):
+        self.create_billing()
+        tokens = self.login()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        urls = [f"/api/v2/billings/{self.billing.id}/result", f"/api/v2/billings/{self.billing.id}/choices",
+                "/api/v2/parties", "/api/v2/users/me/friends"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(urls[0])
+        with CaptureQueriesContext(connection) as queries:
+            for url in urls:
+                self.assertEqual(self.client.get(url).status_code, 200)
+        # neither the user row nor the revocation table is looked up, joins for usernames are fine
+        lookups = [q['sql'] for q in queries if re.search(r'FROM "(auth_user|rest_revokedtoken)" WHERE', q['sql'])]
+        self.assertEqual(lookups, [])
+
+        response = self.client.post("/api/v2/contributions", {"contribution": 5, "billing": self.billing.id},
+                                    format='json')
+        self.assertEqual(response.data['user'], "user0")
+
+    def test_refresh_rotates_and_logout_revokes(self):
+        self.create_billing()
+        tokens = self.login()
+        refreshed = self.client.post("/api/v2/token/refresh", {"refresh": tokens['refresh']}).data
+        self.assertIn('access', refreshed)
+        response = self.client.post("/api/v2/token/refresh", {"refresh": tokens['refresh']})
+        self.assertEqual(response.status_code, 401)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {refreshed['access']}")
+        self.assertEqual(self.client.post("/api/v2/logout", {"refresh": refreshed['refresh']}).status_code, 204)
+        self.assertEqual(self.client.get(f"/api/v2/billings/{self.billing.id}").status_code, 401)
+        # another worker process learns of the revocation on its next reload
+        other_process = RevokedAccessTokens()
+        self.assertIn(signing.loads(refreshed['access'], salt="rest.signed-token.access")['jti'], other_process)
+        self.client.credentials()
+        response = self.client.post("/api/v2/token/refresh", {"refresh": refreshed['refresh']})
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout_with_bad_refresh_token(self):
+        self.create_billing()
+        tokens = self.login()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {tokens['auth_token']}")
+        self.assertEqual(self.client.post("/api/v2/logout", {"refresh": tokens['refresh'] + "x"}).status_code, 204)
+        self.assertFalse(Token.objects.exists())
+
+    def test_tampered_token_is_rejected(self):
+        self.create_billing()
+        tokens = self.login()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}x")
+        self.assertEqual(self.client.get(f"/api/v2/billings/{self.billing.id}").status_code, 401)
+
+
+class AsyncReadTest(BillingFixtureMixin, APITransactionTestCase):
+    def setUp(self):
+        self.create_billing()
+        self.urls = ["/api/v2/parties", f"/api/v2/parties/{self.party.id}",
+                     f"/api/v2/billings/{self.billing.id}", f"/api/v2/billings/{self.billing.id}/choices"]
+        self.expected = {url: self.client.get(url).json() for url in self.urls}
+
+    async def test_reads_are_offloaded_under_asgi(self):
+        client = AsyncClient()
+        token = issue_tokens(self.users[0])['access']
+        for url in self.urls:
+            with mock.patch('rest.async_views.sync_to_async', wraps=sync_to_async) as offloaded:
+                response = await client.get(url, authorization=f"Bearer {token}")
+            self.assertEqual(response.status_code, 200)
+            offloaded.assert_called_once_with(mock.ANY, thread_sensitive=False)
+            self.assertEqual(response.json(), self.expected[url])
+
+    async def test_permissions_still_apply(self):
+        outsider = await sync_to_async(User.objects.create_user)("outsider", "outsider@example.com", "password")
+        response = await AsyncClient().get(f"/api/v2/billings/{self.billing.id}",
+                                           authorization=f"Bearer {issue_tokens(outsider)['access']}")
+        self.assertEqual(response.status_code, 403)
+
+    async def test_profiled_reads_are_captured(self):
+        self.users[0].is_staff = True
+        await sync_to_async(self.users[0].save)()
+        url = f"/api/v2/billings/{self.billing.id}"
+        with tempfile.TemporaryDirectory() as directory, override_settings(PROFILE_CAPTURE_DIR=directory):
+            response = await AsyncClient().get(url, x_profile='1',
+                                               authorization=f"Bearer {issue_tokens(self.users[0])['access']}")
+            self.assertEqual(response.json(), self.expected[url])
+            details = await sync_to_async(self.client.get)(f"/api/v2/profiles/{response['X-Profile-Id']}")
+        self.assertIn('retrieve', details.data['stats'])
+        self.assertGreater(details.data['query_count'], 0)
+
+
+class EventStreamTest(BillingFixtureMixin, APITransactionTestCase):
+    def setUp(self):
+        self.create_billing()
+
+    async def open_stream(self, user):
+        token = issue_tokens(user)['access']
+        scope = {'type': 'http', 'method': 'GET', 'path': f"/api/v2/billings/{self.billing.id}/events",
+                 'query_string': urlencode({'token': token}).encode(), 'headers': []}
+        sent = asyncio.Queue()
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+        stream = asyncio.ensure_future(EventStreamRouter(None)(scope, receive, sent.put))
+        return stream, sent, disconnect
+
+    async def next_body(self, sent):
+        return (await asyncio.wait_for(sent.get(), 5))['body']
+
+    async def test_changes_are_pushed(self):
+        stream, sent, disconnect = await self.open_stream(self.users[1])
+        self.assertEqual((await sent.get())['status'], 200)
+        self.assertIn(b'event: connected', await self.next_body(sent))
+
+        await sync_to_async(self.client.post)("/api/v2/contributions", {"contribution": 5, "billing": self.billing.id},
+                                              format='json')
+        self.assertIn(b'event: contribution_added', await self.next_body(sent))
+        await sync_to_async(self.client.post)(f"/api/v2/billings/{self.billing.id}/calculate")
+        self.assertIn(b'event: calculation_ready', await self.next_body(sent))
+
+        disconnect.set()
+        await asyncio.wait_for(stream, 5)
+
+    async def test_only_members_can_subscribe(self):
+        outsider = await sync_to_async(User.objects.create_user)("outsider", "outsider@example.com", "password")
+        stream, sent, _ = await self.open_stream(outsider)
+        await asyncio.wait_for(stream, 5)
+        self.assertEqual((await sent.get())['status'], 403)
@@ -14,8 +14,15 @@ router.register(r'choices', ChoiceViewSet, 'Choice')
 
 urlpatterns = [
     path('users_all', users),
+    path('users/search', users_search),
+    path('batch', batch),
+    path('metrics', request_metrics),
+    path('profiles', profiles),
+    path('profiles/<slug:capture_id>', profile_detail),
+    path('profiles/<slug:capture_id>/download', profile_download),
     path('', include(router.urls)),
-    path('login', views.TokenCreateView.as_view()),
-    path('logout', views.TokenDestroyView.as_view()),
+    path('login', LoginView.as_view()),
+    path('logout', LogoutView.as_view()),
+    path('token/refresh', token_refresh),
     path('users/me/friends', friends),
 ]
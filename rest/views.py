@@ -1,11 +1,33 @@
-from django.db import transaction
+import json
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+from django.http import FileResponse, HttpResponse
+from djoser import views as djoser_views
 from rest_framework import viewsets, status, mixins
 
 from rest.serializers import *
-from rest_framework.decorators import action, api_view
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
-from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.exceptions import AuthenticationFailed, NotFound, PermissionDenied, ValidationError
 from .permissions import IsPartyHost, IsPartyMember, ViewSetActionPermissionMixin
+from .authentication import (REFRESH, SignedTokenAuthentication, issue_tokens, read_token, refresh_tokens,
+                             revoke_access, revoke_refresh)
+from .balances import refresh_balances, release_quantity, reserve_quantity
+from .batch import run_batch
+from .calculation import get_result, submit_job
+from .conditional import billing_etag, conditional_response, list_etag, party_etag
+from .db import write_transaction
+from .events import (CHOICES_CHANGED, CONTRIBUTION_ADDED, CONTRIBUTION_REMOVED, CONTRIBUTION_UPDATED,
+                     publish_on_commit)
+from .membership import add_members, find_users, remove_members
+from .metrics import render as render_metrics
+from .pagination import paginated_response
+from .profiling import capture_path, list_captures
+from .search import search_users
+from .settlement import GREEDY, MODES
 
 
 def check_party_permissions(view):
@@ -49,15 +71,26 @@ class PartyViewSet(ViewSetActionPermissionMixin, viewsets.ViewSet):
         return Response({"detail": "Party destroyed"})
 
     def retrieve(self, request, pk):
-        party = get_object(Party, pk=pk)
+        party = get_object(Party, pk, PartySerializer.setup_select_related(Party.objects.all()))
         self.check_object_permissions(request, party)
-        serializer = PartySerializer(party)
-        return Response(serializer.data)
+        etag = party_etag(request, party)
+        response = conditional_response(request, etag)
+        if response is not None:
+            return response
+        response = Response(PartyReadSerializer(party).data)
+        response['ETag'] = etag
+        return response
 
     def list(self, request):
-        parties = request.user.parties.all()
-        serializer = PartySerializer(parties, many=True)
-        return Response(serializer.data)
+        versions = list(Party.objects.filter(members=request.user.id).order_by('id').values_list('id', 'version'))
+        etag = list_etag(request, 'parties', versions)
+        response = conditional_response(request, etag)
+        if response is not None:
+            return response
+        parties = PartySerializer.setup_select_related(Party.objects.filter(members=request.user.id))
+        response = paginated_response(request, parties, PartyReadSerializer, self)
+        response['ETag'] = etag
+        return response
 
     def partial_update(self, request, pk):
         party = get_object(Party, pk=pk)
@@ -72,29 +105,25 @@ class PartyViewSet(ViewSetActionPermissionMixin, viewsets.ViewSet):
     def invite(self, request, pk):
         party = get_object(Party, pk=pk)
         self.check_object_permissions(request, party)
-        serializer = UserSerializer(data=request.data, many=True)
+        serializer = UserIdSerializer(data=request.data, many=True)
         if not serializer.is_valid():
             return Response({"detail": "User data for invite is not valid"}, status=status.HTTP_400_BAD_REQUEST)
-        for user_dict in serializer.validated_data:
-            user_id = user_dict["id"]
-            user_to_invite = get_object(User, user_id)
-            user_to_invite.parties.add(party)
-        return Response({"detail": "Users are invited"})
+        found, not_found = find_users(user_dict["id"] for user_dict in serializer.validated_data)
+        add_members(party, found)
+        return Response({"detail": "Users are invited", "not_found": not_found})
 
     @action(detail=True, methods=['delete'])
     def ban(self, request, pk):
         party = get_object(Party, pk)
         self.check_object_permissions(request, party)
-        serializer = UserSerializer(data=request.data, many=True)
+        serializer = UserIdSerializer(data=request.data, many=True)
         if not serializer.is_valid():
             return Response({"detail": "User data for ban is not valid"}, status=status.HTTP_400_BAD_REQUEST)
-        for user_dict in serializer.validated_data:
-            user_id = user_dict["id"]
-            user_to_ban = get_object(User, user_id)
-            if user_to_ban == party.host:
-                raise PermissionDenied(detail="Party host can't be banned", code=403)
-            user_to_ban.parties.remove(party)
-        return Response({"detail": "Users are banned"})
+        found, not_found = find_users(user_dict["id"] for user_dict in serializer.validated_data)
+        if party.host_id in found:
+            raise PermissionDenied(detail="Party host can't be banned", code=403)
+        remove_members(party, found)
+        return Response({"detail": "Users are banned", "not_found": not_found})
 
 
 class BillingViewSet(ViewSetActionPermissionMixin, viewsets.ViewSet):
@@ -103,25 +132,41 @@ class BillingViewSet(ViewSetActionPermissionMixin, viewsets.ViewSet):
         'retrieve': [IsPartyMember],
         'update': [IsPartyMember],
         'calculate': [IsPartyMember],
+        'result': [IsPartyMember],
+        'calculation_jobs': [IsPartyMember],
         'choices': [IsPartyMember],
     }
 
     def retrieve(self, request, pk):
-        billing = get_object(Billing, pk)
+        queryset = BillingSerializer.setup_select_related(Billing.objects.select_related('party'))
+        billing = get_object(Billing, pk, queryset)
         party = billing.party
         self.check_object_permissions(request, party)
-        serializer = BillingSerializer(billing)
-        return Response(serializer.data)
+        etag = billing_etag(request, billing)
+        response = conditional_response(request, etag)
+        if response is not None:
+            return response
+        response = Response(BillingReadSerializer(billing).data)
+        response['ETag'] = etag
+        return response
 
     def update(self, request, pk):
-        billing = get_object(Billing, pk)
-        party = billing.party
-        self.check_object_permissions(request, party)
-        serializer = BillingSerializer(billing, data=request.data)
-        if not serializer.is_valid():
-            return Response({"detail": "Billing data for update is not valid"}, status=status.HTTP_400_BAD_REQUEST)
-        serializer.save()
-        return Response(serializer.data)
+        # the If-Match check and the update can't be split by another writer
+        with write_transaction():
+            billing = get_object(Billing, pk)
+            party = billing.party
+            self.check_object_permissions(request, party)
+            response = conditional_response(request, billing_etag(request, billing))
+            if response is not None:
+                return response
+            serializer = BillingSerializer(billing, data=request.data)
+            if not serializer.is_valid():
+                return Response({"detail": "Billing data for update is not valid"}, status=status.HTTP_400_BAD_REQUEST)
+            serializer.save()
+        billing = get_object(Billing, pk, BillingSerializer.setup_eager_loading(Billing.objects.all()))
+        response = Response(BillingSerializer(billing).data)
+        response['ETag'] = billing_etag(request, billing)
+        return response
 
     @action(detail=True, methods=['post'])
     def calculate(self, request, pk):
@@ -129,82 +174,112 @@ class BillingViewSet(ViewSetActionPermissionMixin, viewsets.ViewSet):
         party = billing.party
         self.check_object_permissions(request, party)
 
-        if not billing or billing.records.count() == 0:
-            return Response({"detail": "Billing is empty. Nothing to calculate"}, status=status.HTTP_400_BAD_REQUEST)
-
-        party_members = party.members.all()
-        balance = Balance(list(party_members), billing.total)
-
-        for c in billing.contributions.all():
-            balance.addContribution(c.user, c.contribution)
-
-        if balance.total_balance < 0:
-            return Response({"detail": "Unable to calculate - total contribution is not enough"},
-                            status=status.HTTP_400_BAD_REQUEST)
-
-        for record in billing.records.all():
-            product_quantity = record.quantity
-            total_record_price = record.price * product_quantity
-            choices = record.choices.all()
-            amount_picked_by_members = sum([c.quantity for c in choices])
-            if amount_picked_by_members < product_quantity:
-                return Response({"detail": f"Some amount of {record.product} is left unpicked"},
-                                status=status.HTTP_400_BAD_REQUEST)
-
-            delta = total_record_price / amount_picked_by_members
-            for choice in choices:
-                quantity_by_member = choice.quantity
-                debt = quantity_by_member * delta
-                balance.addDebt(choice.user, debt)
+        mode = request.query_params.get('mode', GREEDY)
+        if mode not in MODES:
+            return Response({"detail": f"Unknown calculation mode {mode}"}, status=status.HTTP_400_BAD_REQUEST)
 
-        debt_records, from_change = balance.final(billing)
+        if request.query_params.get('async') in ('1', 'true'):
+            job = submit_job(billing, mode)
+            return Response(CalculationJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+        return Response(get_result(billing, mode))
 
-        with transaction.atomic():
-            billing.debts.all().delete()
-            billing.change.all().delete()
+    @action(detail=True, methods=['get'])
+    def result(self, request, pk):
+        billing = get_object(Billing, pk)
+        party = billing.party
+        self.check_object_permissions(request, party)
 
-            debts = DebtRecord.objects.bulk_create(debt_records)
-            change = DebtFromChangeRecord.objects.bulk_create(from_change)
+        mode = request.query_params.get('mode', billing.calculated_mode or GREEDY)
+        if mode not in MODES:
+            return Response({"detail": f"Unknown calculation mode {mode}"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_result(billing, mode, save=False))
 
-        serializer = ResultSerializer({'debts': debts, 'change': change})
-        return Response(serializer.data)
+    @action(detail=True, methods=['get'], url_path=r'calculation-jobs/(?P<job_id>[0-9]+)')
+    def calculation_jobs(self, request, pk, job_id):
+        billing = get_object(Billing, pk)
+        party = billing.party
+        self.check_object_permissions(request, party)
+        job = billing.calculation_jobs.filter(pk=job_id).first()
+        if not job:
+            raise NotFound(detail="Calculation job is not found", code=404)
+        return Response(CalculationJobSerializer(job).data)
 
     @action(detail=True, methods=['get'])
     def contributions(self, request, pk):
         billing = get_object(Billing, pk)
         party = billing.party
         self.check_object_permissions(request, party)
-        contributions = billing.contributions.all()
-        serializer = ContributionSerializer(contributions, many=True)
-        return Response(serializer.data)
+        contributions = ContributionSerializer.setup_eager_loading(billing.contributions.all())
+        return paginated_response(request, contributions, ContributionSerializer, self)
 
     @action(detail=True, methods=['get', 'post'])
     def choices(self, request, pk):
         billing = get_object(Billing, pk)
         party = billing.party
         self.check_object_permissions(request, party)
-        choices = billing.choices.filter(user=request.user)
+        choices = billing.choices.filter(user_id=request.user.id)
         if request.method == 'GET':
-            serializer = ChoiceSerializer(choices, many=True)
-            return Response(serializer.data)
+            return Response(ChoiceReadSerializer(choices, many=True).data)
         if request.method == 'POST':
-            choices.delete()
             serializer = ChoiceSerializer(data=request.data, many=True)
             if not serializer.is_valid():
                 return Response({"detail": "Choice data for update is not valid"}, status=status.HTTP_400_BAD_REQUEST)
-            serializer.save(user=request.user, billing=billing)
+            try:
+                with write_transaction():
+                    record_ids = serializer.replace(billing, request.user.id)
+                    if record_ids:
+                        refresh_balances(billing, record_ids=record_ids, user_ids=[request.user.id])
+                        publish_on_commit(billing, CHOICES_CHANGED, user=request.user.id)
+            except IntegrityError:
+                return Response({"detail": "Each item can be picked only once"}, status=status.HTTP_400_BAD_REQUEST)
             return Response(status=status.HTTP_200_OK)
 
 
+class LoginView(djoser_views.TokenCreateView):
+    def _action(self, serializer):
+        response = super()._action(serializer)
+        response.data.update(issue_tokens(serializer.user))
+        return response
+
+
+class LogoutView(djoser_views.TokenDestroyView):
+    def post(self, request):
+        if isinstance(request.successful_authenticator, SignedTokenAuthentication):
+            revoke_access(request.auth)
+        serializer = RefreshTokenSerializer(data=request.data)
+        if serializer.is_valid():
+            try:
+                revoke_refresh(read_token(serializer.validated_data['refresh'], REFRESH))
+            except AuthenticationFailed:
+                # an expired or broken refresh token can't be used anyway
+                pass
+        return super().post(request)
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def token_refresh(request):
+    serializer = RefreshTokenSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({"detail": "Refresh token is missing"}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(refresh_tokens(serializer.validated_data['refresh']))
+
+
 @api_view(['GET', 'POST'])
 def friends(request):
     if request.method == 'GET':
-        user = request.user
-        friends_list = [profile.user for profile in user.profile.friends.all()]
-        serializer = UserSerializer(friends_list, many=True)
-        return Response(serializer.data)
+        version = Profile.objects.filter(user_id=request.user.id).values_list('friends_version', flat=True).first()
+        etag = list_etag(request, 'friends', version) if version is not None else None
+        response = conditional_response(request, etag) if etag else None
+        if response is not None:
+            return response
+        friends_list = User.objects.filter(profile__followees__user_id=request.user.id)
+        response = paginated_response(request, friends_list, UserSerializer)
+        if etag:
+            response['ETag'] = etag
+        return response
     if request.method == 'POST':
-        user_profile = request.user.profile
+        user_profile = Profile.objects.get(user_id=request.user.id)
         serializer = UserSerializer(data=request.data, many=True)
         if not serializer.is_valid():
             return Response({"detail": "User data for update is not valid"}, status=status.HTTP_400_BAD_REQUEST)
@@ -212,17 +287,68 @@ def friends(request):
             return Response({"detail": "Users list was empty"}, status=status.HTTP_200_OK)
         for user_dict in serializer.validated_data:
             member = get_object(User, user_dict['id'])
-            if member == request.user:
+            if member.id == request.user.id:
                 continue
             user_profile.friends.add(member.profile)
-        user_profile.save()
+        Profile.objects.filter(pk=user_profile.pk).update(friends_version=F('friends_version') + 1)
         return Response(status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 def users(request):
-    serializer = UserSerializer(User.objects.all(), many=True)
-    return Response(serializer.data)
+    return paginated_response(request, User.objects.all(), UserSerializer)
+
+
+@api_view(['POST'])
+def batch(request):
+    serializer = BatchRequestSerializer(data=request.data, many=True)
+    if not serializer.is_valid():
+        return Response({"detail": "Batch data is not valid"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(serializer.validated_data) > settings.BATCH_MAX_REQUESTS:
+        return Response({"detail": f"At most {settings.BATCH_MAX_REQUESTS} requests can be batched"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    responses, committed = run_batch(request, serializer.validated_data)
+    return Response({"committed": committed, "responses": responses},
+                    status=status.HTTP_200_OK if committed else responses[-1]['status'])
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def request_metrics(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def profiles(request):
+    return Response(list_captures())
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def profile_detail(request, capture_id):
+    path = capture_path(capture_id, '.json')
+    if path is None:
+        raise NotFound(detail="Profile is not found", code=404)
+    return Response(json.loads(path.read_text()))
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def profile_download(request, capture_id):
+    path = capture_path(capture_id, '.prof')
+    if path is None:
+        raise NotFound(detail="Profile is not found", code=404)
+    return FileResponse(path.open('rb'), as_attachment=True, filename=path.name)
+
+
+@api_view(['GET'])
+def users_search(request):
+    serializer = UserSearchSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response({"detail": "Search query is not valid"}, status=status.HTTP_400_BAD_REQUEST)
+    found = search_users(request.user, serializer.validated_data['q'], serializer.validated_data['limit'])
+    return Response(UserSerializer(found, many=True).data)
 
 
 class ContributionViewSet(mixins.ListModelMixin,
@@ -237,7 +363,7 @@ class ContributionViewSet(mixins.ListModelMixin,
 
     def get_queryset(self):
         user = self.request.user
-        return user.contributions.all()
+        return self.get_serializer_class().setup_eager_loading(user.contributions.all())
 
     def validated_choice_fields(self, data):
         if type(data['contribution']) != int or type(data['billing']) != int:
@@ -256,14 +382,29 @@ class ContributionViewSet(mixins.ListModelMixin,
         self.check_object_permissions(request, party)
         user = request.user
         contrib = valid_data.pop('contribution')
-        contribution = Contribution.objects.create(user=user, contribution=contrib, billing=check)
+        with write_transaction():
+            contribution = Contribution.objects.create(user=user, contribution=contrib, billing=check)
+            refresh_balances(check, user_ids=[user.id])
+            publish_on_commit(check, CONTRIBUTION_ADDED, user=user.id, contribution=contribution.id)
         return Response(ContributionSerializer(contribution).data)
 
+    def perform_update(self, serializer):
+        with write_transaction():
+            contribution = serializer.save()
+            refresh_balances(contribution.billing, user_ids=[contribution.user_id])
+            publish_on_commit(contribution.billing, CONTRIBUTION_UPDATED, user=contribution.user_id,
+                              contribution=contribution.id)
+
     def destroy(self, request, pk):
         contribution = get_object(Contribution, pk)
         if contribution.user != request.user:
             return Response({'detail': "Contribution doesn't belong to user"}, status=status.HTTP_401_UNAUTHORIZED)
-        contribution.delete()
+        with write_transaction():
+            contribution_id = contribution.id
+            contribution.delete()
+            refresh_balances(contribution.billing, user_ids=[contribution.user_id])
+            publish_on_commit(contribution.billing, CONTRIBUTION_REMOVED, user=contribution.user_id,
+                              contribution=contribution_id)
         return Response(status=status.HTTP_200_OK)
 
 
@@ -288,7 +429,14 @@ class ChoiceViewSet(ViewSetActionPermissionMixin,
 
     def get_queryset(self):
         user = self.request.user
-        return user.choices.all()
+        return self.get_serializer_class().setup_eager_loading(user.choices.all())
+
+    def perform_destroy(self, instance):
+        with write_transaction():
+            instance.delete()
+            release_quantity(instance.record_id, instance.quantity)
+            refresh_balances(instance.billing, record_ids=[instance.record_id], user_ids=[instance.user_id])
+            publish_on_commit(instance.billing, CHOICES_CHANGED, user=instance.user_id)
 
     def create(self, request):
         valid_data = self.validated_choice_fields(request.data)
@@ -305,10 +453,13 @@ class ChoiceViewSet(ViewSetActionPermissionMixin,
             return Response({"detail": "No such record in billing"}, status=status.HTTP_400_BAD_REQUEST)
         if record.quantity < quantity:
             return Response({"detail": "Quantity exceeds amount of product"}, status=status.HTTP_400_BAD_REQUEST)
-        user_choices = check.choices.filter(user=request.user, record=record).first()
-        if user_choices:
+        try:
+            with write_transaction():
+                choice = Choice.objects.create(user=request.user, record=record, billing=check, quantity=quantity)
+                if not reserve_quantity(record.id, quantity):
+                    raise ValidationError({"detail": "Quantity exceeds amount of product left"})
+                refresh_balances(check, record_ids=[record.id])
+                publish_on_commit(check, CHOICES_CHANGED, user=request.user.id)
+        except IntegrityError:
             return Response({"detail": "This item is already picked by user"}, status=status.HTTP_400_BAD_REQUEST)
-        serializer = BillingSerializer(data=valid_data)
-        serializer.is_valid()
-        choice = serializer.save(user=request.user, record=record, billing=check)
         return Response(ChoiceSerializer(choice).data)